@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTTLCache:
+    """Кэш результатов асинхронных запросов со сроком жизни; одновременные промахи по ключу ждут один запрос"""
+
+    def __init__(self, ttl: float, name: str = "cache"):
+        self.ttl = ttl
+        self.name = name
+        self._values: dict[Hashable, tuple[float, Any]] = {}
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # Промахи, дождавшиеся уже идущего запроса
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Возвращает значение из кэша или None, если его нет или срок истек"""
+        entry = self._values.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        """Кладет в кэш значение, полученное в обход get_or_load (например, внутри пакетного запроса)"""
+        self._values[key] = (time.monotonic() + self.ttl, value)
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool] = bool,
+    ) -> Any:
+        """Возвращает значение из кэша или загружает его; в кэш попадают только значения, для которых cache_if истинно"""
+        entry = self._values.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, loader, cache_if))
+            self._inflight[key] = task
+        # shield: отмена одного из ожидающих не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], cache_if: Callable[[Any], bool]) -> Any:
+        generation = self._generation
+        try:
+            value = await loader()
+            # Если кэш сбросили, пока шел запрос, его результат мог уже устареть
+            if generation == self._generation and cache_if(value):
+                self._values[key] = (time.monotonic() + self.ttl, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, key: Hashable, only_if: Callable[[Any], bool] | None = None):
+        """Удаляет одно значение; с only_if - только если оно удовлетворяет условию (например, еще не обновлено)"""
+        entry = self._values.get(key)
+        if entry is not None and (only_if is None or only_if(entry[1])):
+            del self._values[key]
+            self.invalidations += 1
+
+    def clear(self):
+        """Сбрасывает все значения"""
+        if self._values:
+            logger.info(f"Cache '{self.name}' cleared ({len(self._values)} entries)")
+        self._values.clear()
+        self._generation += 1
+        self.invalidations += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._values),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+        }
@@ -6,22 +6,39 @@ load_dotenv()
 import asyncio
 import logging
 import random
+import time
+from typing import Any, Awaitable, Callable
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery, InputMediaPhoto, InaccessibleMessage
+from aiogram.filters import ExceptionTypeFilter
+from aiogram.types import Message, CallbackQuery, ErrorEvent, InaccessibleMessage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 # from aiogram.filters import Text  # Закомментировано, так как может быть недоступен в текущей версии aiogram
 
 import config
-from content_generator import generate_post_text
-from publisher import publish_telegram_post, publish_vk_post
+from chat_queue import chat_serializer
+from content_generator import MAX_POST_TOKENS, build_template_prompt, build_topic_prompt, generate_post_texts, generate_post_texts_stream, get_service_type, llm_breaker, llm_client
+from dedup import duplicate_index
+from draft_pool import draft_pool
+from image_processing import image_processor
+from media_groups import media_groups
+from photo_cache import photo_cache
+from drafts_store import draft_store
+from fsm_storage import SQLiteStorage
+from generations import GenerationCancelled, generation_tracker
+from outbox import outbox
+from scheduler import get_timezone, parse_schedule_time, post_scheduler
+from telegram_limiter import telegram_limiter
+from vk_client import vk_client
+from vk_preupload import photo_preuploader
+from vk_publisher import vk_lookup_cache
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)  # Увеличиваем уровень логирования для отображения информационных сообщений
@@ -53,11 +70,13 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     # request_timeout больше не поддерживается в aiogram 3.x
 )
-storage = MemoryStorage()
+# Все запросы к Telegram идут через общий ограничитель: лимиты на бота и на чат, ожидание после RetryAfter
+bot.session.middleware(telegram_limiter)
+# Состояния диалога храним в SQLite, чтобы незаконченный пост пережил перезапуск бота
+storage = SQLiteStorage() if config.FSM_STORAGE == 'sqlite' else MemoryStorage()
 dp = Dispatcher(storage=storage)
-
-# Семафор для ограничения параллельных публикаций
-publish_semaphore = asyncio.Semaphore(2)
+# Разные чаты обрабатываются параллельно, обновления одного чата - по очереди, без двойных нажатий
+dp.update.outer_middleware(chat_serializer)
 
 # Оптимизация потребления памяти - уменьшаем размер пула соединений
 
@@ -68,6 +87,7 @@ class PostStates(StatesGroup):
     ready_to_publish = State()
     editing_post = State()
     waiting_for_topic = State()
+    waiting_for_schedule_time = State()
 
 # Удаляем неиспользуемый код
 # Вместо сохранения фото на диск, будем хранить только file_id в состоянии
@@ -83,71 +103,209 @@ async def command_start_handler(message: Message):
         reply_markup=get_start_keyboard()
     )
 
-# Функция для безопасного редактирования сообщений
-async def safe_edit_message(callback: CallbackQuery, text: str, reply_markup=None):
-    max_retries = 2
-    retry_count = 0
+# Обработчик команды /stats - служебная статистика для админа
+@dp.message(Command("stats"))
+async def command_stats_handler(message: Message):
+    if message.from_user and str(message.from_user.id) != str(config.ADMIN_ID):
+        return
     
-    while retry_count <= max_retries:
+    llm_stats = llm_client.get_stats()
+    breaker_stats = llm_breaker.get_stats()
+    pool_stats = draft_pool.get_stats()
+    dedup_stats = duplicate_index.get_stats()
+    lookup_stats = vk_lookup_cache.get_stats()
+    photo_stats = photo_cache.get_stats()
+    image_stats = image_processor.get_stats()
+    preupload_stats = photo_preuploader.get_stats()
+    outbox_stats = outbox.get_stats()
+    schedule_stats = post_scheduler.get_stats()
+    queue_stats = chat_serializer.get_stats()
+    generation_stats = generation_tracker.get_stats()
+    telegram_stats = telegram_limiter.get_stats()
+    if isinstance(storage, SQLiteStorage):
+        fsm_stats = storage.get_stats()
+        fsm_line = f"Состояния диалогов: {fsm_stats['keys']} в памяти, записей на диск {fsm_stats['flushes']} ({fsm_stats['rows_written']} строк)"
+    else:
+        fsm_line = "Состояния диалогов: только в памяти"
+    vk_stats = "\n".join(
+        f"  {method}: {stats['calls']} вызовов, ошибок {stats['errors']}, p50 {stats['p50_ms']} мс, p90 {stats['p90_ms']} мс"
+        for method, stats in vk_client.get_stats().items()
+    ) or "  запросов не было"
+    await message.answer(
+        "📊 Статистика\n\n"
+        f"LLM: холодных запросов {llm_stats['cold_requests']} (в среднем {llm_stats['cold_avg_ms']} мс), "
+        f"теплых {llm_stats['warm_requests']} (в среднем {llm_stats['warm_avg_ms']} мс)\n"
+        f"Первый токен: в среднем {llm_stats['first_token_avg_ms']} мс\n"
+        f"Хеджирование: {llm_stats['hedged_requests']} запросов, запасной выиграл {llm_stats['hedge_wins']}\n"
+        f"Отмененные генерации: {generation_stats['cancelled']} из {generation_stats['started']}, "
+        f"сэкономлено ~{generation_stats['tokens_saved']} токенов\n"
+        f"Предохранитель LLM: {breaker_stats['state']}, сбоев подряд {breaker_stats['consecutive_failures']}, "
+        f"отклонено {breaker_stats['rejected']}\n"
+        f"Пул черновиков: попаданий {pool_stats['hits']}, промахов {pool_stats['misses']}, готово {sum(pool_stats['ready'].values())}\n"
+        f"Индекс похожих постов: {dedup_stats['posts']} постов, проверок {dedup_stats['checks']}, отброшено дубликатов {dedup_stats['rejected']}\n"
+        f"Контент-план: готово черновиков {draft_store.count_ready(config.get_current_season())}\n"
+        f"Очередь публикаций: ждут {outbox_stats['pending']}, опубликовано {outbox_stats['published']}, "
+        f"с ошибками {outbox_stats['failed']}, повторов {outbox_stats['retries']}, повторных нажатий {outbox_stats['duplicates']}\n"
+        f"Отложенные посты: запланировано {schedule_stats['scheduled']}, опубликовано по расписанию {schedule_stats['fired']}, "
+        f"среднее опоздание {schedule_stats['avg_lag_ms']} мс\n"
+        f"{fsm_line}\n"
+        f"Очередь обновлений: ждали очереди {queue_stats['waited']}, отброшено двойных нажатий {queue_stats['duplicates']}, "
+        f"переполнений {queue_stats['overflows']}, макс. глубина {queue_stats['max_depth']}\n"
+        f"Кэш фото в VK: {photo_stats['entries']} фото, попаданий {photo_stats['hits']}, промахов {photo_stats['misses']}\n"
+        f"Обработка фото: {'включена' if image_stats['enabled'] else 'выключена'}, "
+        f"{image_stats['processed']} фото, {image_stats['mb_in']} МБ -> {image_stats['mb_out']} МБ\n"
+        f"Предзагрузка фото в VK: загружено {preupload_stats['uploaded']}, использовано при публикации {preupload_stats['used']}, "
+        f"отменено {preupload_stats['cancelled']}, удалено {preupload_stats['deleted']}\n"
+        f"Telegram API: ожиданий лимита {telegram_stats['throttled']} ({telegram_stats['total_wait_s']} с), "
+        f"флуд-контроль {telegram_stats['flood_errors']} раз, повторов {telegram_stats['retries']}\n"
+        f"VK API (ожиданий лимита {vk_client.rate_limiter.throttled}, вызовов в execute {vk_client.batched_calls}, кэш прав и ID группы: "
+        f"попаданий {lookup_stats['hits']}, промахов {lookup_stats['misses']}):\n{vk_stats}"
+    )
+
+@dp.errors(ExceptionTypeFilter(GenerationCancelled))
+async def generation_cancelled_handler(event: ErrorEvent):
+    # Генерацию отменило более новое действие в чате - оно само покажет результат, здесь делать нечего
+    logger.info(f"Generation for update {event.update.update_id} was superseded")
+
+# Функция для безопасного редактирования сообщений
+async def safe_edit_message(callback: CallbackQuery, text: str, reply_markup=None, silent: bool = False):
+    # silent=True - для промежуточных обновлений: без всплывающих ошибок.
+    # Повторять после флуд-контроля не нужно - это делает telegram_limiter, а прочие ошибки повтор не исправит
+    try:
+        # Проверяем, что callback.message существует и является обычным сообщением (а не InaccessibleMessage)
+        if callback.message and not isinstance(callback.message, InaccessibleMessage) and getattr(callback.message, "message_id", None):
+            await callback.message.edit_text(text, reply_markup=reply_markup)
+        elif not silent:
+            await callback.answer(text[:199] if len(text) > 199 else text, show_alert=True) # Ограничение длины для show_alert
+    except Exception as e:
+        if silent:
+            logger.debug(f"Skipped draft update in safe_edit_message: {e}")
+            return
+        await callback.answer(f"Ошибка: {str(e)[:190]}", show_alert=True)
+        logger.warning(f"Error in safe_edit_message: {e}")
+
+class ThrottledEditor:
+    """Показывает черновик поста по мере генерации, редактируя сообщение не чаще одного раза в interval_ms"""
+
+    def __init__(self, edit: Callable[[str], Awaitable[Any]], interval_ms: int = config.STREAM_EDIT_INTERVAL_MS):
+        self._edit = edit
+        self._interval = interval_ms / 1000
+        self._last_edit = 0.0
+        self._last_text = ""
+        self._started = time.perf_counter()
+        self._pending: asyncio.Task | None = None
+        self._dropped = False
+        self.first_text_ms: float | None = None
+
+    async def update(self, text: str):
+        now = time.perf_counter()
+        if self._dropped or text == self._last_text or now - self._last_edit < self._interval:
+            return
+        # Редактирование идет в фоне: ожидание лимита Telegram не должно тормозить чтение потока.
+        # Пока предыдущее не ушло, новые промежуточные тексты пропускаем
+        if self._pending is not None and not self._pending.done():
+            return
+        self._last_edit = now
+        self._last_text = text
+        self._pending = asyncio.create_task(self._send(text))
+
+    def drop(self):
+        """Отменяет неотправленное обновление и не шлет новых (генерацию сменила более новая)"""
+        self._dropped = True
+        if self._pending is not None and not self._pending.done():
+            self._pending.cancel()
+
+    async def close(self):
+        """Отменяет неотправленное обновление и дожидается его остановки, чтобы оно не затерло итоговый текст"""
+        self.drop()
+        if self._pending is not None:
+            await asyncio.gather(self._pending, return_exceptions=True)
+
+    async def _send(self, text: str):
         try:
-            # Проверяем, что callback.message существует и является обычным сообщением (а не InaccessibleMessage)
-            if callback.message and not isinstance(callback.message, InaccessibleMessage) and getattr(callback.message, "message_id", None):
-                await callback.message.edit_text(text, reply_markup=reply_markup)
-                return  # Успешно отредактировали сообщение
-            else:
-                await callback.answer(text[:199] if len(text) > 199 else text, show_alert=True) # Ограничение длины для show_alert
-                return  # Успешно отправили ответ
+            await self._edit(f"✍️ Пишу пост...\n\n{text}")
         except Exception as e:
-            retry_count += 1
-            if retry_count > max_retries:
-                await callback.answer(f"Ошибка: {str(e)[:19] if len(str(e)) > 199 else str(e)}", show_alert=True)
-                # Логируем ошибку без подробного стека для экономии ресурсов
-                logger.warning(f"Error in safe_edit_message after {max_retries + 1} attempts: {e}")  # Изменяем уровень логирования на warning
-                return
-            # Небольшая задержка перед повторной попыткой
-            await asyncio.sleep(0.5)
+            # Промежуточные обновления не критичны - финальный текст все равно будет показан
+            logger.debug(f"Failed to update draft preview: {e}")
+            return
+        if self.first_text_ms is None:
+            # Время до первого видимого текста - главная метрика отзывчивости
+            self.first_text_ms = (time.perf_counter() - self._started) * 1000
+            logger.info(f"Первый текст черновика показан через {self.first_text_ms:.0f} мс")
+
+async def generate_with_preview(chat_id: int, prompt: str, service_type: str, edit: Callable[[str], Awaitable[Any]]) -> list[str]:
+    """Генерирует пост и запасные варианты для перегенерации; в потоковом режиме показывает черновик через edit.
+
+    Более новое действие в чате отменяет генерацию - тогда выбрасывается GenerationCancelled.
+    """
+    n = 1 + max(config.AI_PREFETCH_ALTERNATIVES, 0)
+    editor = None
+    if not config.AI_STREAMING:
+        generation = generate_post_texts(prompt, service_type, n=n)
+    else:
+        editor = ThrottledEditor(edit)
+
+        async def on_text(text: str):
+            generation_tracker.progress(chat_id, text)
+            await editor.update(text)
+
+        generation = generate_post_texts_stream(prompt, service_type, on_text=on_text, n=n)
+    # Генерация идет до 90 с - на это время отдаем очередь чата, чтобы следующие нажатия не ждали ее
+    async with chat_serializer.released():
+        try:
+            texts = await generation_tracker.run(
+                chat_id, generation, token_budget=n * MAX_POST_TOKENS, on_cancel=editor.drop if editor else None,
+            )
+        finally:
+            # Отложенную правку останавливаем до возврата очереди: иначе она могла бы затереть сообщение следующего обработчика
+            if editor is not None:
+                await editor.close()
+    # Варианты, похожие на уже опубликованные посты, до админа не доходят
+    return duplicate_index.prefer_unique(texts)
+
+def duplicate_warning(post_text: str) -> str:
+    """Возвращает предупреждение, если пост похож на опубликованный ранее"""
+    match = duplicate_index.find_similar(post_text)
+    if not match:
+        return ""
+    score, _, preview = match
+    return f"\n\n⚠️ Похоже на опубликованный ранее пост ({score:.0%}): «{preview}...»"
 
 # Обработчик callback'ов
 # Возвращаем F.data == "..." так как Text фильтр может быть недоступен в текущей версии aiogram
 @dp.callback_query(F.data == "generate_post")
 async def generate_post_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    # Проверяем, не идет ли уже генерация
-    if await state.get_state() == PostStates.generating:
-        await callback.answer("Подожди, идёт генерация поста...")
-        return
+    # Новый запрос отменяет еще идущую генерацию, чтобы ее результат не затер этот пост
+    await generation_tracker.cancel(state.key.chat_id)
     await state.set_state(PostStates.generating)
     
-    await safe_edit_message(callback, "💭 Генерирую случайный пост...")
-    
     # Случайный выбор типа поста
     template_key = random.choice(list(config.POST_TEMPLATES.keys()))
-    template_text = config.POST_TEMPLATES[template_key]
-    
-    # Определяем тип услуги для генерации текста
-    if template_key in ["pedicure_work", "seasonal_special", "client_feedback"]:
-        service_type = "pedicure"
-    else:
-        service_type = "manicure_pedicure"
     
-    # Добавляем контактный блок к шаблону
-    prompt_with_contact = f"{template_text}\n\nВ конце поста **обязательно** добавь следующий блок с контактами:\n\n{config.CONTACT_BLOCK}"
-    
-    # Генерируем пост
-    post_text = await generate_post_text(prompt_with_contact, service_type)
+    # Берем готовый черновик из пула, а если его нет - генерируем пост
+    post_text = draft_pool.take(template_key)
+    alternatives = []
+    if not post_text:
+        await safe_edit_message(callback, "💭 Генерирую случайный пост...")
+        prompt_with_contact = build_template_prompt(template_key)
+        texts = await generate_with_preview(state.key.chat_id, prompt_with_contact, get_service_type(template_key), lambda text: safe_edit_message(callback, text, silent=True))
+        post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
         # Сохраняем сгенерированный пост и текущий шаблон в состояние
-        await state.update_data(generated_post=post_text, photos=[], current_template=template_key)
+        await photo_preuploader.discard(state.key.chat_id)
+        await state.update_data(generated_post=post_text, alternatives=alternatives, photos=[], vk_attachments={}, current_template=template_key)
         
         # Отправляем сгенерированный пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await safe_edit_message(callback, f"Сгенерированный пост:\n\n{post_text}", reply_markup=builder.as_markup())
+        await safe_edit_message(callback, f"Сгенерированный пост:\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
     else:
         await safe_edit_message(callback, "Не удалось сгенерировать пост. Попробуйте снова.")
 
@@ -167,35 +325,37 @@ async def process_topic_text(message: Message, state: FSMContext):
         await message.answer("Тема не может быть пустой. Пожалуйста, пришли тему поста еще раз.")
         return
     
+    await generation_tracker.cancel(state.key.chat_id)
     await state.set_state(PostStates.generating)
-    await message.answer(f"Принял тему: '{topic}'. Генерирую пост...")
+    status_message = await message.answer(f"Принял тему: '{topic}'. Генерирую пост...")
     
     # Используем универсальный шаблон, адаптируя его под заданную тему
     season = get_current_season() # Получаем текущее время года
-    template_text = (
-        f"Ты — Валерия, мастер маникюра и педикюра из Самары. Твой стиль — дружелюбный, живой и искренний. "
-        f"Напиши интересный и полезный пост на тему: '{topic}'. "
-        f"Учитывай время года: сейчас {season}. "
-        f"Пиши простым языком, как будто общаешься с подругой. Используй 1-2 уместных эмодзи (например, 💖, ✨, 💅, 🔥). "
-        f"Текст должен быть информативным и engaging. Не используй специальное форматирование (жирный шрифт, курсив). "
-        f"Длина текста — около 300-500 символов."
-    )
+    template_text = build_topic_prompt(topic, season)
     
-    # Генерируем пост
-    post_text = await generate_post_text(template_text, "manicure_pedicure")
+    # Генерируем пост, показывая черновик в статусном сообщении
+    texts = await generate_with_preview(state.key.chat_id, template_text, "manicure_pedicure", lambda text: status_message.edit_text(text))
+    post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
         # Сохраняем сгенерированный пост и тему в состояние
-        await state.update_data(generated_post=post_text, photos=[], current_template="topic_based", topic=topic)
+        await photo_preuploader.discard(state.key.chat_id)
+        await state.update_data(generated_post=post_text, alternatives=alternatives, photos=[], vk_attachments={}, current_template="topic_based", topic=topic)
         
         # Отправляем сгенерированный пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post_topic")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await message.answer(f"Сгенерированный пост на тему '{topic}':\n\n{post_text}", reply_markup=builder.as_markup())
+        final_text = f"Сгенерированный пост на тему '{topic}':\n\n{post_text}{duplicate_warning(post_text)}"
+        try:
+            # Заменяем черновик итоговым постом в том же сообщении
+            await status_message.edit_text(final_text, reply_markup=builder.as_markup())
+        except Exception:
+            await message.answer(final_text, reply_markup=builder.as_markup())
     else:
         await message.answer("Не удалось сгенерировать пост на заданную тему. Попробуйте снова." + "\n\n" + "Пришли тему поста еще раз.")
 
@@ -203,40 +363,68 @@ async def process_topic_text(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "generate_pedicure_post")
 async def generate_pedicure_post_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    # Проверяем, не идет ли уже генерация
-    if await state.get_state() == PostStates.generating:
-        await callback.answer("Подожди, идёт генерация поста...")
-        return
+    # Новый запрос отменяет еще идущую генерацию, чтобы ее результат не затер этот пост
+    await generation_tracker.cancel(state.key.chat_id)
     await state.set_state(PostStates.generating)
     
     await safe_edit_message(callback, "💭 Генерирую пост о педикюре...")
     
-    # Выбираем шаблон для педикюра
+    # Выбираем шаблон для педикюра и добавляем к нему контактный блок
     template_key = "pedicure_work"
-    template_text = config.POST_TEMPLATES[template_key]
-    service_type = "pedicure"
-    
-    # Добавляем контактный блок к шаблону
-    prompt_with_contact = f"{template_text}\n\nВ конце поста **обязательно** добавь следующий блок с контактами:\n\n{config.CONTACT_BLOCK}"
+    prompt_with_contact = build_template_prompt(template_key)
     
     # Генерируем пост
-    post_text = await generate_post_text(prompt_with_contact, service_type)
+    texts = await generate_with_preview(state.key.chat_id, prompt_with_contact, get_service_type(template_key), lambda text: safe_edit_message(callback, text, silent=True))
+    post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
         # Сохраняем сгенерированный пост и текущий шаблон в состояние
-        await state.update_data(generated_post=post_text, photos=[], current_template=template_key)
+        await photo_preuploader.discard(state.key.chat_id)
+        await state.update_data(generated_post=post_text, alternatives=alternatives, photos=[], vk_attachments={}, current_template=template_key)
         
         # Отправляем сгенерированный пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await safe_edit_message(callback, f"Сгенерированный пост о педикюре:\n\n{post_text}", reply_markup=builder.as_markup())
+        await safe_edit_message(callback, f"Сгенерированный пост о педикюре:\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
     else:
         await safe_edit_message(callback, "Не удалось сгенерировать пост о педикюре. Попробуйте снова.")
 
+@dp.callback_query(F.data == "plan_draft")
+async def plan_draft_handler(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await generation_tracker.cancel(state.key.chat_id)
+    
+    # Берем следующий черновик, заранее сгенерированный content_plan.py
+    # Черновики другого сезона (зимний план весной) не предлагаем
+    season = config.get_current_season()
+    draft = draft_store.take_next(season)
+    if not draft:
+        await safe_edit_message(callback, "Черновиков на этот сезон в контент-плане нет. Сгенерируйте их командой: python content_plan.py", reply_markup=get_start_keyboard())
+        return
+    
+    post_text = draft["text"]
+    topic = draft["topic"]
+    await photo_preuploader.discard(state.key.chat_id)
+    await state.update_data(
+        generated_post=post_text, alternatives=[], photos=[], vk_attachments={},
+        current_template="topic_based" if topic else draft["template_key"], topic=topic,
+    )
+    
+    # Отправляем черновик с кнопками
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Опубликовать", callback_data="publish_now")
+    builder.button(text="⏰ Запланировать", callback_data="schedule_post")
+    builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post_topic" if topic else "regenerate_post")
+    builder.button(text="📷 Добавить фото", callback_data="add_photo")
+    builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
+    
+    await safe_edit_message(callback, f"Пост из контент-плана (осталось {draft_store.count_ready(season)}):\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
+
 # Функция для получения клавиатуры с типами постов
 def get_post_type_keyboard():
     builder = InlineKeyboardBuilder()
@@ -252,6 +440,7 @@ def get_post_type_keyboard():
 @dp.callback_query(F.data.startswith("template_"))
 async def handle_template_selection(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
+    await generation_tracker.cancel(state.key.chat_id)
     
     if callback.data:
         template_key = callback.data.replace("template_", "")
@@ -259,79 +448,76 @@ async def handle_template_selection(callback: CallbackQuery, state: FSMContext):
         await safe_edit_message(callback, "Произошла ошибка. Пожалуйста, начните заново.")
         return
         
-    # Проверяем наличие шаблона
-    template_text = config.POST_TEMPLATES.get(template_key)
-    if not template_text:
+    # Проверяем наличие шаблона и добавляем к нему контактный блок
+    prompt_with_contact = build_template_prompt(template_key)
+    if not prompt_with_contact:
         await safe_edit_message(callback, "Неизвестный тип поста. Пожалуйста, выберите снова.")
         return
     
-    # Определяем тип услуги для генерации текста
-    if template_key in ["pedicure_work", "seasonal_special", "client_feedback"]:
-        service_type = "pedicure"
-    else:
-        service_type = "manicure_pedicure"
-    
-    # Добавляем контактный блок к шаблону
-    prompt_with_contact = f"{template_text}\n\nВ конце поста **обязательно** добавь следующий блок с контактами:\n\n{config.CONTACT_BLOCK}"
-    
-    await safe_edit_message(callback, "💭 Генерирую пост...")
-    
-    # Генерируем пост
-    post_text = await generate_post_text(prompt_with_contact, service_type)
+    # Берем готовый черновик из пула, а если его нет - генерируем пост
+    post_text = draft_pool.take(template_key)
+    alternatives = []
+    if not post_text:
+        await safe_edit_message(callback, "💭 Генерирую пост...")
+        texts = await generate_with_preview(state.key.chat_id, prompt_with_contact, get_service_type(template_key), lambda text: safe_edit_message(callback, text, silent=True))
+        post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
         # Сохраняем сгенерированный пост и текущий шаблон в состояние
-        await state.update_data(generated_post=post_text, photos=[], current_template=template_key)
+        await photo_preuploader.discard(state.key.chat_id)
+        await state.update_data(generated_post=post_text, alternatives=alternatives, photos=[], vk_attachments={}, current_template=template_key)
         
         # Отправляем сгенерированный пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await safe_edit_message(callback, f"Сгенерированный пост:\n\n{post_text}", reply_markup=builder.as_markup())
+        await safe_edit_message(callback, f"Сгенерированный пост:\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
     else:
         await safe_edit_message(callback, "Не удалось сгенерировать пост. Попробуйте снова.")
 
 @dp.callback_query(F.data == "regenerate_post")
 async def regenerate_post_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
+    # Перегенерация во время генерации отменяет предыдущую
+    await generation_tracker.cancel(state.key.chat_id)
     
-    # Получаем текущий шаблон из состояния
+    # Получаем текущий шаблон и запасные варианты из состояния
     data = await state.get_data()
     current_template = data.get('current_template', 'beautiful_work')
-    template_text = config.POST_TEMPLATES.get(current_template)
-    if not template_text:
-        await safe_edit_message(callback, "Неизвестный тип поста. Пожалуйста, начните сначала.")
-        return
+    alternatives = data.get('alternatives', [])
     
-    # Определяем тип услуги для генерации текста
-    if current_template in ["pedicure_work", "seasonal_special", "client_feedback"]:
-        service_type = "pedicure"
+    if alternatives:
+        # Берем следующий вариант, сгенерированный вместе с текущим постом, без обращения к модели
+        post_text, alternatives = alternatives[0], alternatives[1:]
     else:
-        service_type = "manicure_pedicure"
-    
-    # Добавляем контактный блок к шаблону
-    prompt_with_contact = f"{template_text}\n\nВ конце поста **обязательно** добавь следующий блок с контактами:\n\n{config.CONTACT_BLOCK}"
-    
-    await safe_edit_message(callback, "💭 Перегенерирую пост...")
-    
-    # Генерируем новый пост
-    post_text = await generate_post_text(prompt_with_contact, service_type)
+        prompt_with_contact = build_template_prompt(current_template)
+        if not prompt_with_contact:
+            await safe_edit_message(callback, "Неизвестный тип поста. Пожалуйста, начните сначала.")
+            return
+        
+        await safe_edit_message(callback, "💭 Перегенерирую пост...")
+        
+        # Генерируем новый пост
+        texts = await generate_with_preview(state.key.chat_id, prompt_with_contact, get_service_type(current_template), lambda text: safe_edit_message(callback, text, silent=True))
+        post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
-        # Обновляем сгенерированный пост в состоянии
-        await state.update_data(generated_post=post_text)
+        # Обновляем сгенерированный пост и оставшиеся варианты в состоянии
+        await state.update_data(generated_post=post_text, alternatives=alternatives)
         
         # Отправляем новый пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await safe_edit_message(callback, f"Новый пост:\n\n{post_text}", reply_markup=builder.as_markup())
+        await safe_edit_message(callback, f"Новый пост:\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
     else:
         await safe_edit_message(callback, "Не удалось сгенерировать пост. Попробуйте снова.")
 
@@ -344,40 +530,50 @@ async def add_photo_handler(callback: CallbackQuery, state: FSMContext):
 # Обработчик фото
 @dp.message(PostStates.waiting_for_photos, F.photo)
 async def photo_handler(message: Message, state: FSMContext):
-    # Получаем текущие фото из состояния
-    data = await state.get_data()
-    photos = data.get('photos', [])
-    
-    # Ограничиваем количество фото до максимально возможного в Telegram (10) и в конфиге
-    max_photos_for_telegram = min(10, config.MAX_PHOTOS_PER_POST)
-    if len(photos) >= max_photos_for_telegram:
-        await message.answer(f"Максимальное количество фото в посте: {max_photos_for_telegram}")
+    # Фото альбома приходят отдельными сообщениями - обрабатываем альбом целиком в первом из них
+    messages = await media_groups.collect(message)
+    if messages is None:
         return
     
     # Получаем ID фото (берем самое высокое качество)
-    if message.photo and len(message.photo) > 0:
-        photo_id = message.photo[-1].file_id
-        file_info = await bot.get_file(photo_id)
-        
-        # Убираем проверку размера файла, чтобы позволить загружать фото любого размера
-        # if file_info.file_size and file_info.file_size > config.MAX_PHOTO_SIZE_MB * 1024 * 1024:
-        #     await message.answer(f"Фото слишком большое. Максимальный размер: {config.MAX_PHOTO_SIZE_MB} МБ")
-        #     return
-        
-        photos.append(photo_id)
-    else:
+    received = [item.photo[-1] for item in messages if item.photo]
+    if not received:
         await message.answer("Ошибка: фото не найдено.")
         return
     
-    # Обновляем состояние с новым списком фото
+    # Ограничиваем количество фото до максимально возможного в Telegram (10) и в конфиге
+    max_photos_for_telegram = min(10, config.MAX_PHOTOS_PER_POST)
+    chat_id = state.key.chat_id
+    # Обработчик снова держит очередь чата (collect вернул ее после ожидания альбома) - фото другого обработчика не потеряются
+    data = await state.get_data()
+    photos = data.get('photos', [])
+    added = received[:max(0, max_photos_for_telegram - len(photos))]
+    photos = photos + [photo.file_id for photo in added]
     await state.update_data(photos=photos)
     
+    if not added:
+        await message.answer(f"Максимальное количество фото в посте: {max_photos_for_telegram}")
+        return
+    
+    # Сразу загружаем фото в VK в фоне: к публикации останется только wall.post
+    # Загрузка заканчивается вне обработчика - состояние меняем, заняв очередь чата
+    async def on_saved(file_id: str, attachment: str):
+        async with chat_serializer.hold(chat_id):
+            data = await state.get_data()
+            await state.update_data(vk_attachments={**data.get('vk_attachments', {}), file_id: attachment})
+    for photo in added:
+        photo_preuploader.start(chat_id, bot, photo, on_saved)
+    
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Готово, все фото загружены", callback_data="photos_done")
     builder.button(text="📷 Добавить еще фото", callback_data="add_more_photos")
     
+    skipped = len(received) - len(added)
+    added_text = "Фото добавлено." if len(received) == 1 else f"Добавлено фото: {len(added)}."
+    if skipped:
+        added_text += f" Не поместилось: {skipped} (максимум {max_photos_for_telegram})."
     await message.answer(
-        f"Фото добавлено. Всего фото: {len(photos)}\nМожешь добавить еще или завершить загрузку.",
+        f"{added_text} Всего фото: {len(photos)}\nМожешь добавить еще или завершить загрузку.",
         reply_markup=builder.as_markup()
     )
 
@@ -397,6 +593,7 @@ async def photos_done_handler(callback: CallbackQuery, state: FSMContext):
     # Отправляем подтверждение
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Опубликовать", callback_data="publish_now")
+    builder.button(text="⏰ Запланировать", callback_data="schedule_post")
     builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
     builder.button(text="📷 Добавить фото", callback_data="add_photo")
     builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
@@ -410,19 +607,12 @@ async def add_more_photos_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     await safe_edit_message(callback, "Продолжай отправлять фото.")
 
-@dp.callback_query(F.data == "publish_now")
-async def publish_now_handler(callback: CallbackQuery, state: FSMContext):
-    await callback.answer()
-    await safe_edit_message(callback, "Публикую пост...")
-    
-    # Получаем пост и фото из состояния
-    data = await state.get_data()
+def prepare_publication(data: dict) -> tuple[str, list[str], dict[str, str]] | None:
+    """Текст, фото и уже загруженные в VK вложения поста из состояния FSM, обрезанные до лимитов площадок"""
     post_text = data.get('generated_post')
     photos = data.get('photos', [])
-    
     if not post_text:
-        await safe_edit_message(callback, "Ошибка: нет сгенерированного поста.")
-        return
+        return None
     
     # Проверяем длину текста поста
     if len(post_text) > 3000:
@@ -432,94 +622,133 @@ async def publish_now_handler(callback: CallbackQuery, state: FSMContext):
     max_photos_for_telegram = min(10, config.MAX_PHOTOS_PER_POST)
     if photos and len(photos) > max_photos_for_telegram:
         photos = photos[:max_photos_for_telegram]
+    vk_attachments = {file_id: attachment for file_id, attachment in data.get('vk_attachments', {}).items() if file_id in photos}
+    return post_text, photos, vk_attachments
+
+@dp.callback_query(F.data == "publish_now")
+async def publish_now_handler(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
     
-    # Подготовка медиагруппы для Telegram
-    media_group = []
-    if photos:
-        media_group = [InputMediaPhoto(media=file_id) for file_id in photos]
-        # Ограничиваем количество фото в медиагруппе до максимально возможного в Telegram и в конфиге
-        media_group = media_group[:max_photos_for_telegram]
+    # Получаем пост и фото из состояния
+    publication = prepare_publication(await state.get_data())
+    if not publication:
+        await safe_edit_message(callback, "Ошибка: нет сгенерированного поста.")
+        return
+    post_text, photos, vk_attachments = publication
+    
+    # Публикует фоновая задача из очереди на диске: пост не теряется при перезапуске или сбое VK.
+    # Ключ идемпотентности: повторное нажатие кнопки не поставит тот же пост второй раз
+    chat_id = state.key.chat_id
+    message_id = callback.message.message_id if callback.message else None
+    key = outbox.make_key(chat_id, message_id, post_text, photos)
+    job_id, created = outbox.enqueue(key, post_text, photos, vk_attachments, chat_id=chat_id, message_id=message_id)
+    if created:
+        # Фото, которые еще загружаются в VK в фоне, достанутся задаче публикации, а не будут загружаться заново
+        photo_preuploader.hand_over(chat_id, outbox.preupload_key(job_id))
+    
+    # Очищаем состояние: пост уже сохранен в очереди
+    await state.clear()
+    await safe_edit_message(callback, "⏳ Пост поставлен в очередь на публикацию..." if created else "⏳ Этот пост уже в очереди на публикацию.")
+
+def format_schedule_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, get_timezone()).strftime("%d.%m.%Y %H:%M")
+
+async def schedule_publication(state: FSMContext, run_at: float, message_id: int | None) -> bool:
+    """Откладывает пост из состояния FSM на run_at; в нужное время он попадет в ту же очередь публикаций, что и при публикации сразу"""
+    publication = prepare_publication(await state.get_data())
+    if not publication:
+        return False
+    post_text, photos, vk_attachments = publication
+    chat_id = state.key.chat_id
+    key = outbox.make_key(chat_id, message_id, post_text, photos, run_at)
+    post_id = post_scheduler.add(run_at, key, post_text, photos, vk_attachments, chat_id=chat_id, message_id=message_id)
+    # Фоновые загрузки фото в VK дождутся публикации вместе с постом
+    photo_preuploader.hand_over(chat_id, post_scheduler.preupload_key(post_id))
+    await state.clear()
+    return True
+
+@dp.callback_query(F.data == "schedule_post")
+async def schedule_post_handler(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
     
-    try:
-        # Ограничиваем параллельные публикации с помощью семафора
-        async with publish_semaphore:
-            # Публикуем в Telegram и VK параллельно
-            # Публикуем в Telegram и VK параллельно с корректным указанием return_exceptions=True
-            telegram_result, vk_result = await asyncio.gather(
-                publish_telegram_post(bot, post_text, media_group),
-                publish_vk_post(bot, post_text, photos),
-                return_exceptions=True # Это именованный параметр, указываем явно
-            )
-        
-        # Проверяем результаты публикации
-        # Функции могут возвращать True, False, None или исключение
-        # None означает успешное выполнение без явного возврата значения
-        telegram_success = telegram_result is True or telegram_result is None or (telegram_result is not False and not isinstance(telegram_result, Exception))
-        vk_success = vk_result is True or vk_result is None or (vk_result is not False and not isinstance(vk_result, Exception))
-        
-        # Если VK не удался, отправляем уведомление в Telegram админу
-        if not vk_success:
-            error_msg = "❌ ВНИМАНИЕ: Пост не опубликован в VK. "
-            if isinstance(vk_result, Exception):
-                error_msg += f"Ошибка: {str(vk_result)}"
-                # Логируем traceback ошибки VK для отладки
-                logger.error(f"VK publication error: {vk_result}", exc_info=True)
-            else:
-                error_msg += "Неизвестная ошибка"
-            
-            # Отправляем уведомление админу в Telegram
-            try:
-                await bot.send_message(
-                    config.ADMIN_ID,
-                    f"⚠️ Ошибка публикации в VK:\n\n{error_msg}\n\nПост был опубликован только в Telegram канале."
-                )
-            except Exception as notify_error:
-                logger.error(f"Не удалось отправить уведомление об ошибке VK админу: {notify_error}")
-        else:
-            # Логируем успешную публикацию в VK
-            logger.info("Пост успешно опубликован в VK")
-        
-        # Очищаем состояние после публикации
-        await state.clear()
-        
-        # Убираем удаление объектов, так как Python сам управляет памятью
-        # del post_text
-        # del photos
-        # if media_group:
-        #     media_group.clear()
-        # del media_group
-        
-        # Формируем сообщение о результате публикации
-        # Уточняем логику: если функция не вернула False или исключение, считаем успехом
-        if telegram_success and vk_success:
-            result_message = "✅ Пост успешно опубликован в Telegram и VK!"
-        elif telegram_success:
-            result_message = "✅ Пост опубликован в Telegram.\n⚠️ Не удалось опубликовать в VK (админ уведомлен)."
-        elif vk_success:
-            result_message = "✅ Пост опубликован в VK.\n⚠️ Не удалось опубликовать в Telegram."
-        else:
-            # Проверяем, были ли вообще попытки публикации
-            if telegram_result is None and vk_result is None:
-                result_message = "✅ Пост успешно опубликован!"
-            else:
-                result_message = "❌ Не удалось опубликовать пост ни в Telegram, ни в VK."
-        
-        await safe_edit_message(callback, result_message)
-        
-    except Exception as e:
-        logger.error(f"Error during publishing: {e}", exc_info=False) # Убираем подробное логирование
-        await safe_edit_message(callback, f"❌ Ошибка при публикации: {e}")
-        # Очищаем состояние даже при ошибке
-        await state.clear()
-        # Убираем удаление объектов даже при ошибке, так как Python сам управляет памятью
-        # if 'post_text' in locals():
-        #     del post_text
-        # if 'photos' in locals():
-        #     del photos
-        # if 'media_group' in locals():
-        #     if media_group:
-        #         media_group.clear()
-        #     del media_group
+    data = await state.get_data()
+    if not data.get('generated_post'):
+        await safe_edit_message(callback, "Ошибка: нет сгенерированного поста.")
+        return
+    
+    # Готовые варианты: через N часов - относительно момента нажатия, завтра - в указанное время
+    tomorrow = datetime.now(get_timezone()).replace(second=0, microsecond=0) + timedelta(days=1)
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Через 1 час", callback_data="schedule_in:3600")
+    builder.button(text="Через 3 часа", callback_data="schedule_in:10800")
+    for hour in (10, 19):
+        builder.button(text=f"Завтра в {hour}:00", callback_data=f"schedule_at:{int(tomorrow.replace(hour=hour, minute=0).timestamp())}")
+    builder.button(text="✏️ Указать время", callback_data="schedule_custom")
+    builder.button(text="✅ Опубликовать сейчас", callback_data="publish_now")
+    builder.adjust(2, 2, 1, 1)
+    
+    await safe_edit_message(callback, f"Когда опубликовать пост?\n\n{data['generated_post']}", reply_markup=builder.as_markup())
+
+@dp.callback_query(F.data.startswith("schedule_in:") | F.data.startswith("schedule_at:"))
+async def schedule_preset_handler(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    
+    kind, value = callback.data.split(":", 1)
+    run_at = time.time() + int(value) if kind == "schedule_in" else float(value)
+    message_id = callback.message.message_id if callback.message else None
+    if not await schedule_publication(state, run_at, message_id):
+        await safe_edit_message(callback, "Ошибка: нет сгенерированного поста.")
+        return
+    await safe_edit_message(callback, f"⏰ Пост запланирован на {format_schedule_time(run_at)}.\nСписок отложенных постов: /scheduled")
+
+@dp.callback_query(F.data == "schedule_custom")
+async def schedule_custom_handler(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await safe_edit_message(callback, "Напиши время публикации: ЧЧ:ММ (ближайшее), ДД.ММ ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ")
+    await state.set_state(PostStates.waiting_for_schedule_time)
+
+@dp.message(PostStates.waiting_for_schedule_time, F.text)
+async def process_schedule_time(message: Message, state: FSMContext):
+    run_at = parse_schedule_time(message.text, datetime.now(get_timezone()))
+    if run_at is None or run_at.timestamp() <= time.time():
+        await message.answer("Не получилось разобрать время или оно уже прошло. Пример: 18:30 или 25.12 10:00")
+        return
+    
+    # Итог публикации придет в это же сообщение
+    reply = await message.answer(f"⏰ Пост запланирован на {format_schedule_time(run_at.timestamp())}.\nСписок отложенных постов: /scheduled")
+    if not await schedule_publication(state, run_at.timestamp(), reply.message_id):
+        await reply.edit_text("Ошибка: нет сгенерированного поста.")
+
+# Список отложенных постов с возможностью отмены
+@dp.message(Command("scheduled"))
+async def command_scheduled_handler(message: Message):
+    if message.from_user and str(message.from_user.id) != str(config.ADMIN_ID):
+        return
+    
+    posts = post_scheduler.list_scheduled()
+    if not posts:
+        await message.answer("Отложенных постов нет.")
+        return
+    
+    builder = InlineKeyboardBuilder()
+    lines = []
+    for post in posts[:20]:
+        when = format_schedule_time(post["run_at"])
+        preview = post["text"][:60].replace("\n", " ")
+        lines.append(f"#{post['id']} {when}: {preview}...")
+        builder.button(text=f"❌ Отменить #{post['id']} ({when})", callback_data=f"cancel_scheduled:{post['id']}")
+    builder.adjust(1)
+    more = f"\n\n...и еще {len(posts) - 20}" if len(posts) > 20 else ""
+    await message.answer("⏰ Отложенные посты:\n\n" + "\n".join(lines) + more, reply_markup=builder.as_markup())
+
+@dp.callback_query(F.data.startswith("cancel_scheduled:"))
+async def cancel_scheduled_handler(callback: CallbackQuery):
+    await callback.answer()
+    post_id = int(callback.data.split(":", 1)[1])
+    if await post_scheduler.cancel(post_id):
+        await safe_edit_message(callback, f"Отложенный пост #{post_id} отменен.")
+    else:
+        await safe_edit_message(callback, f"Пост #{post_id} уже опубликован или отменен.")
 
 # Удаляем дублирующий хендлер publish_handler, так как он делает то же самое, что и publish_now_handler
 
@@ -563,6 +792,7 @@ async def process_edited_text(message: Message, state: FSMContext):
     # Отправляем обновленный пост с кнопками
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Опубликовать", callback_data="publish_now")
+    builder.button(text="⏰ Запланировать", callback_data="schedule_post")
     builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
     builder.button(text="📷 Добавить фото", callback_data="add_photo")
     builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
@@ -585,6 +815,7 @@ async def skip_editing_handler(callback: CallbackQuery, state: FSMContext):
     # Отправляем текущий пост с кнопками
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Опубликовать", callback_data="publish_now")
+    builder.button(text="⏰ Запланировать", callback_data="schedule_post")
     builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post")
     builder.button(text="📷 Добавить фото", callback_data="add_photo")
     builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
@@ -595,6 +826,7 @@ async def skip_editing_handler(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "regenerate_post_topic")
 async def regenerate_topic_post_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
+    await generation_tracker.cancel(state.key.chat_id)
     
     # Получаем текущую тему из состояния
     data = await state.get_data()
@@ -604,34 +836,34 @@ async def regenerate_topic_post_handler(callback: CallbackQuery, state: FSMConte
         await safe_edit_message(callback, "Не найдена тема для генерации поста.")
         return
     
-    await safe_edit_message(callback, f"💭 Перегенерирую пост на тему '{topic}'...")
-    
-    # Используем универсальный шаблон, адаптируя его под заданную тему
-    season = get_current_season() # Получаем текущее время года
-    template_text = (
-        f"Ты — Валерия, мастер маникюра и педикюра из Самары. Твой стиль — дружелюбный, живой и искренний. "
-        f"Напиши интересный и полезный пост на тему: '{topic}'. "
-        f"Учитывай время года: сейчас {season}. "
-        f"Пиши простым языком, как будто общаешься с подругой. Используй 1-2 уместных эмодзи (например, 💖, ✨, 💅, 🔥). "
-        f"Текст должен быть информативным и engaging. Не используй специальное форматирование (жирный шрифт, курсив). "
-        f"Длина текста — около 300-500 символов."
-    )
-    
-    # Генерируем пост
-    post_text = await generate_post_text(template_text, "manicure_pedicure")
+    alternatives = data.get('alternatives', [])
+    if alternatives:
+        # Берем следующий вариант, сгенерированный вместе с текущим постом, без обращения к модели
+        post_text, alternatives = alternatives[0], alternatives[1:]
+    else:
+        await safe_edit_message(callback, f"💭 Перегенерирую пост на тему '{topic}'...")
+        
+        # Используем универсальный шаблон, адаптируя его под заданную тему
+        season = get_current_season() # Получаем текущее время года
+        template_text = build_topic_prompt(topic, season)
+        
+        # Генерируем пост
+        texts = await generate_with_preview(state.key.chat_id, template_text, "manicure_pedicure", lambda text: safe_edit_message(callback, text, silent=True))
+        post_text, alternatives = (texts[0], texts[1:]) if texts else (None, [])
     
     if post_text:
-        # Обновляем сгенерированный пост в состоянии
-        await state.update_data(generated_post=post_text)
+        # Обновляем сгенерированный пост и оставшиеся варианты в состоянии
+        await state.update_data(generated_post=post_text, alternatives=alternatives)
         
         # Отправляем новый пост с кнопками
         builder = InlineKeyboardBuilder()
         builder.button(text="✅ Опубликовать", callback_data="publish_now")
+        builder.button(text="⏰ Запланировать", callback_data="schedule_post")
         builder.button(text="🔁 Сгенерировать заново", callback_data="regenerate_post_topic")
         builder.button(text="📷 Добавить фото", callback_data="add_photo")
         builder.button(text="✏️ Редактировать текст", callback_data="edit_post_text")
         
-        await safe_edit_message(callback, f"Новый пост на тему '{topic}':\n\n{post_text}", reply_markup=builder.as_markup())
+        await safe_edit_message(callback, f"Новый пост на тему '{topic}':\n\n{post_text}{duplicate_warning(post_text)}", reply_markup=builder.as_markup())
     else:
         await safe_edit_message(callback, "Не удалось сгенерировать пост на заданную тему. Попробуйте снова.")
 
@@ -639,6 +871,9 @@ async def regenerate_topic_post_handler(callback: CallbackQuery, state: FSMConte
 @dp.callback_query(F.data == "reset")
 async def reset_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
+    # Сброс останавливает генерацию: запрос к модели обрывается, и черновик не появится в уже сброшенном состоянии
+    await generation_tracker.cancel(state.key.chat_id)
+    await photo_preuploader.discard(state.key.chat_id)
     await state.clear()
     await safe_edit_message(callback, "Состояние сброшено. Выбери действие:", reply_markup=get_start_keyboard())
 
@@ -647,15 +882,20 @@ def get_start_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="🪄 Сгенерировать пост", callback_data="generate_post")
     builder.button(text="📝 Написать пост на тему", callback_data="generate_topic_post")
+    builder.button(text="📚 Из контент-плана", callback_data="plan_draft")
     builder.button(text="📷 Добавить фото", callback_data="add_photo")
     builder.button(text="✅ Опубликовать", callback_data="publish_now")
+    builder.button(text="⏰ Запланировать", callback_data="schedule_post")
     builder.button(text="🔁 Перегенерировать", callback_data="regenerate_post")
     builder.button(text="🔄 Сброс", callback_data="reset")
     # builder.button(text="💅 Педикюр", callback_data="generate_pedicure_post")  # Убираем дублирующую кнопку
     builder.adjust(2, 2, 2, 1)  # Располагаем кнопки по 2 в ряд, последняя кнопка в отдельном ряду
     return builder.as_markup()
 
+import secrets
 import signal
+from aiohttp import web
+from aiogram.methods import TelegramMethod
 
 # Глобальная переменная для управления запуском бота
 # running = True  # Убираем, так как не используется
@@ -672,51 +912,112 @@ async def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
+    # Открываем пул соединений к LLM заранее, чтобы не создавать его при каждой генерации
+    await llm_client.start()
+    await vk_client.start()
+    
+    # Фоновая публикация постов из очереди (в том числе оставшихся с прошлого запуска)
+    outbox.start(bot)
+    post_scheduler.start()
+    
+    # Фоновое заполнение пула черновиков
+    draft_pool.start()
+    
+    try:
+        if config.BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await run_polling()
+    except Exception as e:
+        logger.error(f"Error during {config.BOT_MODE}: {e}", exc_info=False)
+    finally:
+        await draft_pool.stop()
+        await post_scheduler.stop()
+        await outbox.stop()
+        await llm_client.close()
+        await vk_client.close()
+        duplicate_index.close()
+        draft_store.close()
+        outbox.close()
+        post_scheduler.close()
+        # Диспетчер закрывает хранилище сам; повторный вызов только сбросит на диск то, что не успело записаться
+        await storage.close()
+        photo_cache.close()
+        image_processor.close()
+        await bot.session.close()
+        logger.info("Bot stopped.")
+
+async def run_polling():
     # Используем polling с параметрами для работы в контейнере Docker
     # Важно: убедитесь, что только один экземпляр бота запущен одновременно
+    await dp.start_polling(
+        bot,
+        allowed_updates=dp.resolve_used_update_types(),
+        timeout=30,
+        drop_pending_updates=True,  # Сбрасываем старые обновления при запуске
+        handle_signals=False  # Отключаем встроенные сигналы, чтобы использовать свои
+    )
+
+async def run_webhook():
+    """Прием обновлений через webhook на встроенном aiohttp-сервере (HTTPS обеспечивает reverse proxy)"""
+    # Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token - чужие запросы получают 401
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    # Задачи обработки принятых обновлений - чтобы дождаться их при остановке
+    in_flight: set[asyncio.Task] = set()
+
+    async def feed_update(update: dict):
+        result = await dp.feed_raw_update(bot, update)
+        if isinstance(result, TelegramMethod):
+            await dp.silent_call_request(bot, result)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+            return web.Response(status=401, text="Unauthorized")
+        # Telegram сразу получает 200, а обновление обрабатывается в фоне
+        task = asyncio.create_task(feed_update(await request.json(loads=bot.session.json_loads)))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    
     try:
-        await dp.start_polling(
-            bot,
+        await site.start()
+        await dp.emit_startup(bot=bot)
+        # Webhook ставим, когда сервер уже слушает порт; обновления, накопленные за время перезапуска, не сбрасываем
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL + config.WEBHOOK_PATH,
+            secret_token=secret,
             allowed_updates=dp.resolve_used_update_types(),
-            timeout=30,
-            drop_pending_updates=True,  # Сбрасываем старые обновления при запуске
-            handle_signals=False  # Отключаем встроенные сигналы, чтобы использовать свои
+            drop_pending_updates=False,
         )
-    except Exception as e:
-        logger.error(f"Error during polling: {e}", exc_info=False)
+        logger.info(f"Webhook mode: listening on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+        await stop.wait()
+        logger.info("Received interrupt signal. Shutting down gracefully...")
     finally:
-        await bot.session.close()
-        logger.info("Bot stopped.")
-     
-     # # Запуск с webhook (раскомментируйте для использования на сервере с HTTPS)
-     # from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-     # from aiohttp import web
-     #
-     # # Настройка webhook
-     # WEBHOOK_PATH = '/webhook'
-     # # На продакшене укажите реальный домен с HTTPS
-     # WEBHOOK_URL = f'https://your_domain.com{WEBHOOK_PATH}'
-     #
-     # # Установка webhook
-     # await bot.set_webhook(
-     #     url=WEBHOOK_URL,
-     #     drop_pending_updates=True,
-     #     allowed_updates=dp.resolve_used_update_types(),
-     # )
-     #
-     # # Настройка веб-приложения
-     # app = web.Application()
-     # SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
-     # setup_application(app, dp, bot=bot)
-     #
-     # # Запуск веб-сервера
-     # runner = web.AppRunner(app)
-     # await runner.setup()
-     # site = web.TCPSite(runner, 'localhost', 8080) # Используем порт 8080
-     # await site.start()
-     #
-     # # Ожидание завершения
-     # await asyncio.Event().wait()
+        # Снимаем webhook: пока бот выключен, Telegram копит обновления и отдаст их после запуска
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+        except Exception as e:
+            logger.error(f"Failed to delete webhook: {e}")
+        await site.stop()
+        # Дожидаемся обновлений, которые уже приняты (Telegram получил 200 и не пришлет их снова)
+        if in_flight:
+            logger.info(f"Waiting for {len(in_flight)} updates in progress")
+            await asyncio.wait(set(in_flight), timeout=config.WEBHOOK_SHUTDOWN_TIMEOUT)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
 
 if __name__ == "__main__":
     # Запуск с ограничением потребления памяти
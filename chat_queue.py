@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Chat, TelegramObject, Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatSlot:
+    """Очередь обработки одного чата"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.users = 0  # Обработчики чата: ждущие, работающие и временно отдавшие очередь
+        self.callbacks: set[tuple] = set()  # Нажатия кнопок, которые ждут очереди или обрабатываются
+
+
+class _Turn:
+    """Право текущего обработчика на чат: его можно временно отдать на время долгой операции"""
+
+    def __init__(self, slot: _ChatSlot):
+        self.slot = slot
+        self.held = False
+
+
+_current_turn: contextvars.ContextVar[_Turn | None] = contextvars.ContextVar("chat_turn", default=None)
+
+
+class ChatSerializer(BaseMiddleware):
+    """Обновления разных чатов обрабатываются параллельно, одного чата - строго по очереди.
+
+    Очередь чата ограничена max_queue, а повторное нажатие той же кнопки, пока первое еще не обработано, отбрасывается.
+    """
+
+    def __init__(self, max_queue: int = config.CHAT_QUEUE_LIMIT):
+        self.max_queue = max_queue
+        self._slots: dict[int, _ChatSlot] = {}
+        self.waited = 0  # Обновлений, которым пришлось ждать своей очереди
+        self.duplicates = 0
+        self.overflows = 0
+        self.max_depth = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        chat: Chat | None = data.get("event_chat")
+        if chat is None or not isinstance(event, Update):
+            return await handler(event, data)
+        slot = self._slots.setdefault(chat.id, _ChatSlot())
+        callback = event.callback_query
+        callback_key = (callback.message.message_id if callback.message else None, callback.data) if callback else None
+
+        if callback_key in slot.callbacks:
+            self.duplicates += 1
+            await self._reject(event, "⏳ Уже выполняется...")
+            return None
+        if slot.waiting >= self.max_queue:
+            self.overflows += 1
+            logger.warning(f"Chat {chat.id} queue is full ({slot.waiting}), dropping update {event.update_id}")
+            await self._reject(event, "Слишком много действий подряд, подожди немного")
+            return None
+
+        if callback_key is not None:
+            slot.callbacks.add(callback_key)
+        turn = _Turn(slot)
+        token = _current_turn.set(turn)
+        slot.users += 1
+        try:
+            if slot.lock.locked():
+                self.waited += 1
+            slot.waiting += 1
+            self.max_depth = max(self.max_depth, slot.waiting)
+            try:
+                await slot.lock.acquire()
+            finally:
+                slot.waiting -= 1
+            turn.held = True
+            return await handler(event, data)
+        finally:
+            # held ложно, если обработчик отменили, пока он ждал очереди
+            if turn.held:
+                slot.lock.release()
+            _current_turn.reset(token)
+            slot.callbacks.discard(callback_key)
+            self._leave(chat.id, slot)
+
+    def _leave(self, chat_id: int, slot: _ChatSlot):
+        slot.users -= 1
+        if not slot.users:
+            self._slots.pop(chat_id, None)
+
+    @staticmethod
+    async def _reject(event: Update, text: str):
+        if event.callback_query:
+            try:
+                await event.callback_query.answer(text)
+            except Exception as e:
+                logger.debug(f"Failed to answer dropped callback: {e}")
+
+    @asynccontextmanager
+    async def released(self):
+        """Отдает очередь чата на время долгой операции (генерация, ожидание альбома): следующие обновления чата не ждут ее конца"""
+        turn = _current_turn.get()
+        if turn is None or not turn.held:
+            yield
+            return
+        turn.held = False
+        turn.slot.lock.release()
+        try:
+            yield
+        finally:
+            # Результат записываем снова в порядке очереди чата
+            await turn.slot.lock.acquire()
+            turn.held = True
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        """Занимает очередь чата вне обработчика (фоновая задача пишет в состояние чата): ждет текущий обработчик, следующие ждут ее"""
+        slot = self._slots.setdefault(chat_id, _ChatSlot())
+        slot.users += 1
+        try:
+            async with slot.lock:
+                yield
+        finally:
+            self._leave(chat_id, slot)
+
+    def get_stats(self) -> dict:
+        return {
+            "chats": len(self._slots),
+            "waited": self.waited,
+            "duplicates": self.duplicates,
+            "overflows": self.overflows,
+            "max_depth": self.max_depth,
+        }
+
+
+chat_serializer = ChatSerializer()
@@ -42,6 +42,60 @@ AI_BASE_URL = os.getenv('AI_BASE_URL', 'https://openrouter.ai/api/v1/chat/comple
 if not AI_API_KEY:
     print("WARNING: Ни AI_API_KEY, ни OPENROUTER_API_KEY не установлены в .env файле")
 
+def _get_int(name: str, default: int) -> int:
+    """Читает целое число из переменной окружения, при ошибке возвращает значение по умолчанию"""
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        print(f"WARNING: {name} не является числом, используется значение {default}")
+        return default
+
+def _get_float(name: str, default: float) -> float:
+    """Читает дробное число из переменной окружения, при ошибке возвращает значение по умолчанию"""
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        print(f"WARNING: {name} не является числом, используется значение {default}")
+        return default
+
+def _get_bool(name: str, default: bool) -> bool:
+    """Читает флаг из переменной окружения (1/true/yes/on включают)"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Пул соединений HTTP-клиента LLM
+AI_POOL_LIMIT = _get_int('AI_POOL_LIMIT', 10)  # Всего соединений в пуле
+AI_POOL_LIMIT_PER_HOST = _get_int('AI_POOL_LIMIT_PER_HOST', 4)  # Соединений на один хост
+AI_KEEPALIVE_TIMEOUT = _get_int('AI_KEEPALIVE_TIMEOUT', 60)  # Сколько секунд держать простаивающее соединение
+AI_REQUEST_TIMEOUT = _get_int('AI_REQUEST_TIMEOUT', 30)  # Таймаут одного запроса в секундах
+
+# Повторы и предохранитель для запросов к LLM
+AI_RETRY_ATTEMPTS = _get_int('AI_RETRY_ATTEMPTS', 3)
+AI_RETRY_BASE_DELAY_MS = _get_int('AI_RETRY_BASE_DELAY_MS', 1000)  # База экспоненциальной задержки
+AI_RETRY_MAX_DELAY_MS = _get_int('AI_RETRY_MAX_DELAY_MS', 20000)  # Дольше не ждем, даже если просит Retry-After
+AI_BREAKER_FAILURES = _get_int('AI_BREAKER_FAILURES', 5)  # Сбоев подряд до размыкания предохранителя
+AI_BREAKER_RESET_SECONDS = _get_int('AI_BREAKER_RESET_SECONDS', 60)  # Через сколько секунд пробовать снова
+
+# Хеджирование: если основная модель не ответила за p90 своей задержки, параллельно уходит запасной запрос
+AI_FALLBACK_MODEL = os.getenv('AI_FALLBACK_MODEL', '')  # Пусто - повторный запрос к основной модели
+AI_FALLBACK_BASE_URL = os.getenv('AI_FALLBACK_BASE_URL', '') or AI_BASE_URL
+AI_FALLBACK_API_KEY = os.getenv('AI_FALLBACK_API_KEY', '') or AI_API_KEY
+AI_HEDGING = _get_bool('AI_HEDGING', True)
+AI_HEDGE_WINDOW = _get_int('AI_HEDGE_WINDOW', 100)  # Сколько последних задержек учитывать в p90
+AI_HEDGE_MIN_SAMPLES = _get_int('AI_HEDGE_MIN_SAMPLES', 5)  # Пока замеров меньше, используется AI_HEDGE_DEFAULT_MS
+AI_HEDGE_DEFAULT_MS = _get_int('AI_HEDGE_DEFAULT_MS', 10000)
+AI_HEDGE_MIN_MS = _get_int('AI_HEDGE_MIN_MS', 1000)  # Нижняя граница порога, чтобы не дублировать быстрые запросы
+
+# Потоковая генерация: черновик показывается в чате по мере прихода токенов
+AI_STREAMING = _get_bool('AI_STREAMING', True)
+STREAM_EDIT_INTERVAL_MS = _get_int('STREAM_EDIT_INTERVAL_MS', 1000)  # Не чаще одного редактирования сообщения за интервал
+
+# Запасные варианты поста для мгновенной перегенерации
+AI_PREFETCH_ALTERNATIVES = _get_int('AI_PREFETCH_ALTERNATIVES', 2)  # Сколько вариантов держать про запас (0 - отключить)
+AI_USE_N_PARAMETER = _get_bool('AI_USE_N_PARAMETER', False)  # Запрашивать варианты параметром n (если провайдер его поддерживает)
+
 # Удаляем дублирующуюся проверку AI_MODEL
 
 # Тексты для постов
@@ -127,3 +181,83 @@ CONTACT_BLOCK = (
 # Лимиты
 MAX_PHOTO_SIZE_MB = 20 # Максимальный размер фото в МБ (ограничение Telegram API на скачивание файлов)
 MAX_PHOTOS_PER_POST = 10 # Максимальное количество фото в одном посте (увеличен до максимума для Telegram)
+
+# Пул заранее сгенерированных черновиков (0 - отключить)
+DRAFT_POOL_SIZE = _get_int('DRAFT_POOL_SIZE', 1)  # Готовых черновиков на каждый шаблон
+DRAFT_POOL_SEASON_CHECK_INTERVAL = _get_int('DRAFT_POOL_SEASON_CHECK_INTERVAL', 600)  # Как часто (сек) проверять смену сезона
+
+# Каталог для локальных данных бота (индексы, очереди, кэши)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Поиск похожих постов: варианты, слишком похожие на опубликованные, отбрасываются
+DEDUP_INDEX_PATH = os.getenv('DEDUP_INDEX_PATH', os.path.join(DATA_DIR, 'dedup.sqlite3'))
+DEDUP_THRESHOLD = _get_float('DEDUP_THRESHOLD', 0.6)  # Оценка сходства (0..1), с которой пост считается дубликатом; 0 - отключить
+
+# Контент-план: черновики, заранее сгенерированные из командной строки (content_plan.py)
+DRAFTS_DB_PATH = os.getenv('DRAFTS_DB_PATH', os.path.join(DATA_DIR, 'drafts.sqlite3'))
+CONTENT_PLAN_CONCURRENCY = _get_int('CONTENT_PLAN_CONCURRENCY', 4)  # Сколько постов генерировать одновременно
+
+# Ограничение исходящих запросов к Telegram Bot API (публикации в канал обслуживаются раньше обновлений интерфейса)
+TELEGRAM_RATE_LIMIT = _get_float('TELEGRAM_RATE_LIMIT', 30)  # Сообщений в секунду на всего бота; 0 - без ограничения
+TELEGRAM_CHAT_RATE_LIMIT = _get_float('TELEGRAM_CHAT_RATE_LIMIT', 1)  # Сообщений в секунду в один личный чат
+TELEGRAM_GROUP_RATE_LIMIT = _get_float('TELEGRAM_GROUP_RATE_LIMIT', 20)  # Сообщений в минуту в одну группу или канал
+TELEGRAM_RETRY_ATTEMPTS = _get_int('TELEGRAM_RETRY_ATTEMPTS', 3)  # Повторов после ошибки "Too Many Requests: retry after N"
+TELEGRAM_MAX_RETRY_AFTER = _get_int('TELEGRAM_MAX_RETRY_AFTER', 60)  # Дольше этого (с) не ждем - ошибка уходит вызывающему коду
+
+# Клиент VK API: один пул соединений на все запросы
+VK_API_VERSION = os.getenv('VK_API_VERSION', '5.131')
+VK_HTTP2 = _get_bool('VK_HTTP2', True)  # HTTP/2 используется, если установлен пакет h2 (pip install httpx[http2])
+VK_POOL_LIMIT = _get_int('VK_POOL_LIMIT', 10)  # Всего соединений в пуле
+VK_REQUEST_TIMEOUT = _get_int('VK_REQUEST_TIMEOUT', 15)  # Таймаут вызова метода API в секундах
+VK_UPLOAD_TIMEOUT = _get_int('VK_UPLOAD_TIMEOUT', 30)  # Таймаут загрузки фото в секундах
+VK_RATE_LIMIT = _get_float('VK_RATE_LIMIT', 3)  # Запросов к API в секунду (лимит VK для токена пользователя - 3); 0 - без ограничения
+VK_RETRY_ATTEMPTS = _get_int('VK_RETRY_ATTEMPTS', 3)  # Попыток при ошибке 6 "Too many requests per second"
+VK_LOOKUP_CACHE_TTL = _get_int('VK_LOOKUP_CACHE_TTL', 3600)  # Сколько секунд помнить проверку прав токена и ID группы
+VK_UPLOAD_SERVER_TTL = _get_int('VK_UPLOAD_SERVER_TTL', 600)  # Сколько секунд использовать один адрес сервера загрузки фото
+PHOTO_TRANSFER_CHUNK_KB = _get_int('PHOTO_TRANSFER_CHUNK_KB', 64)  # Размер чанка при передаче фото из Telegram в VK
+PHOTO_TRANSFER_BUFFER_CHUNKS = _get_int('PHOTO_TRANSFER_BUFFER_CHUNKS', 8)  # Сколько чанков может ждать отправки в VK
+
+# Кэш уже загруженных в VK фото: file_unique_id из Telegram -> вложение "photo{owner}_{id}"
+PHOTO_CACHE_PATH = os.getenv('PHOTO_CACHE_PATH', os.path.join(DATA_DIR, 'photo_cache.sqlite3'))
+PHOTO_CACHE_MAX_ENTRIES = _get_int('PHOTO_CACHE_MAX_ENTRIES', 5000)  # Сверх этого вытесняются давно не использованные; 0 - отключить
+
+# Уменьшение фото перед загрузкой в VK (Pillow из requirements.txt)
+IMAGE_PROCESSING = _get_bool('IMAGE_PROCESSING', True)  # Работает, только если Pillow установлен
+IMAGE_MIN_SIZE_KB = _get_int('IMAGE_MIN_SIZE_KB', 1024)  # Фото меньше этого не пережимаются, а передаются в VK потоком
+IMAGE_MAX_EDGE = _get_int('IMAGE_MAX_EDGE', 2560)  # Максимальная сторона в пикселях (VK все равно пережимает крупнее)
+IMAGE_JPEG_QUALITY = _get_int('IMAGE_JPEG_QUALITY', 85)
+IMAGE_WORKERS = _get_int('IMAGE_WORKERS', 2)  # Процессов для обработки (и фото в памяти одновременно)
+
+# Очередь публикаций: посты сначала сохраняются на диск, а публикует их фоновая задача с повторами
+OUTBOX_DB_PATH = os.getenv('OUTBOX_DB_PATH', os.path.join(DATA_DIR, 'outbox.sqlite3'))
+OUTBOX_MAX_ATTEMPTS = _get_int('OUTBOX_MAX_ATTEMPTS', 5)  # Попыток публикации в каждую площадку (Telegram, VK)
+OUTBOX_RETRY_DELAY = _get_int('OUTBOX_RETRY_DELAY', 30)  # Пауза перед первым повтором в секундах, дальше удваивается
+OUTBOX_RETRY_MAX_DELAY = _get_int('OUTBOX_RETRY_MAX_DELAY', 900)  # Дольше между повторами не ждем
+# Сколько секунд VK помнит guid поста: повтор позже сначала ищет пост на стене, чтобы не опубликовать его второй раз
+OUTBOX_VK_GUID_WINDOW = _get_int('OUTBOX_VK_GUID_WINDOW', 3600)
+
+# Отложенные публикации
+SCHEDULE_DB_PATH = os.getenv('SCHEDULE_DB_PATH', os.path.join(DATA_DIR, 'schedule.sqlite3'))
+TIMEZONE = os.getenv('TIMEZONE', 'Europe/Samara')  # В этом часовом поясе указывается время публикации; пусто - время сервера
+
+# Альбомы: Telegram присылает каждое фото альбома отдельным сообщением - ждем остальные столько миллисекунд после последнего
+MEDIA_GROUP_DEBOUNCE_MS = _get_int('MEDIA_GROUP_DEBOUNCE_MS', 500)
+
+# Хранилище состояний диалога (FSM): sqlite - черновики переживают перезапуск, memory - как раньше, только в памяти
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite').strip().lower()
+FSM_DB_PATH = os.getenv('FSM_DB_PATH', os.path.join(DATA_DIR, 'fsm.sqlite3'))
+FSM_FLUSH_INTERVAL_MS = _get_int('FSM_FLUSH_INTERVAL_MS', 500)  # Изменения пишутся на диск пачкой не реже этого интервала
+
+# Режим получения обновлений: polling (по умолчанию) или webhook - Telegram сам присылает обновления на встроенный сервер
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')  # Публичный HTTPS-адрес бота без пути, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')  # Адрес и порт встроенного сервера (за reverse proxy с HTTPS)
+WEBHOOK_PORT = _get_int('WEBHOOK_PORT', 8080)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Пусто - случайный секрет при каждом запуске
+WEBHOOK_SHUTDOWN_TIMEOUT = _get_int('WEBHOOK_SHUTDOWN_TIMEOUT', 30)  # Сколько секунд при остановке ждать обработки принятых обновлений
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise RuntimeError("❌ Ошибка: для BOT_MODE=webhook нужен WEBHOOK_URL")
+
+# Обновления одного чата обрабатываются по очереди; сверх этого числа ожидающих новые отбрасываются
+CHAT_QUEUE_LIMIT = _get_int('CHAT_QUEUE_LIMIT', 20)
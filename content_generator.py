@@ -1,10 +1,11 @@
 import asyncio
-import aiohttp
 import logging
-import ssl
-import certifi
 from datetime import datetime
+from typing import Awaitable, Callable
+import config
 from config import AI_BASE_URL, AI_MODEL, AI_API_KEY
+from llm_client import LLMClient, LLMProvider, classify_llm_error
+from retry import CircuitBreaker, CircuitOpenError, RetryPolicy
 
 # Проверяем, что все необходимые переменные окружения определены
 # Убираем проверку при импорте для возможности тестирования
@@ -25,15 +26,64 @@ logging.getLogger("asyncio").setLevel(logging.WARNING)
 
 # Удаляем дублирующуюся функцию, так как она определена в bot.py
 
-async def generate_post_text(prompt: str, service_type: str = "manicure_pedicure", season: str | None = None) -> str | None:
-    # Проверяем наличие API ключа перед выполнением запроса
-    if not AI_API_KEY:
-        logger.error("AI_API_KEY не установлен в .env файле")
+# Общий клиент с пулом соединений: создается один раз, запускается и закрывается в bot.main()
+llm_client = LLMClient(
+    primary=LLMProvider("primary", AI_BASE_URL, AI_API_KEY, AI_MODEL),
+    fallback=LLMProvider(
+        "fallback",
+        config.AI_FALLBACK_BASE_URL,
+        config.AI_FALLBACK_API_KEY,
+        config.AI_FALLBACK_MODEL or AI_MODEL,
+    ),
+)
+
+# Предел длины одного варианта поста в токенах
+MAX_POST_TOKENS = 500
+
+# Шаблоны, для которых текст генерируется как для педикюра
+PEDICURE_TEMPLATES = ["pedicure_work", "seasonal_special", "client_feedback"]
+
+def get_service_type(template_key: str) -> str:
+    """Определяет тип услуги для генерации текста по ключу шаблона"""
+    if template_key in PEDICURE_TEMPLATES:
+        return "pedicure"
+    return "manicure_pedicure"
+
+def build_template_prompt(template_key: str) -> str | None:
+    """Возвращает промпт шаблона из config.POST_TEMPLATES с обязательным контактным блоком"""
+    template_text = config.POST_TEMPLATES.get(template_key)
+    if not template_text:
         return None
+    return f"{template_text}\n\nВ конце поста **обязательно** добавь следующий блок с контактами:\n\n{config.CONTACT_BLOCK}"
 
+def build_topic_prompt(topic: str, season: str | None = None) -> str:
+    """Возвращает промпт для поста на произвольную тему"""
+    season = season or config.get_current_season()
+    return (
+        f"Ты — Валерия, мастер маникюра и педикюра из Самары. Твой стиль — дружелюбный, живой и искренний. "
+        f"Напиши интересный и полезный пост на тему: '{topic}'. "
+        f"Учитывай время года: сейчас {season}. "
+        f"Пиши простым языком, как будто общаешься с подругой. Используй 1-2 уместных эмодзи (например, 💖, ✨, 💅, 🔥). "
+        f"Текст должен быть информативным и engaging. Не используй специальное форматирование (жирный шрифт, курсив). "
+        f"Длина текста — около 300-500 символов."
+    )
+
+# Политика повторов и предохранитель для запросов к LLM
+llm_retry_policy = RetryPolicy(
+    max_attempts=config.AI_RETRY_ATTEMPTS,
+    base_delay=config.AI_RETRY_BASE_DELAY_MS / 1000,
+    max_delay=config.AI_RETRY_MAX_DELAY_MS / 1000,
+)
+llm_breaker = CircuitBreaker(
+    "llm",
+    failure_threshold=config.AI_BREAKER_FAILURES,
+    reset_timeout=config.AI_BREAKER_RESET_SECONDS,
+)
+
+def _build_payload(prompt: str, season: str | None = None) -> dict:
+    """Подставляет время года в промпт и формирует тело запроса к модели"""
     # Если время года не передано, определяем его
     if season is None:
-        from datetime import datetime
         month = datetime.now().month
         if month in [12, 1, 2]:
             season = "зима"
@@ -46,53 +96,126 @@ async def generate_post_text(prompt: str, service_type: str = "manicure_pedicure
     
     # Заменяем плейсхолдер {season} в промпте на актуальное время года
     prompt = prompt.format(season=season)
-        
-    headers = {
-        "Authorization": f"Bearer {AI_API_KEY}",
-        "Content-Type": "application/json",
-        "User-Agent": "ValeriaBot/1.0"
-    }
     
-    data = {
+    return {
         "model": AI_MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ],
-        "max_tokens": 500  # Ограничиваем длину генерации
+        "max_tokens": MAX_POST_TOKENS  # Ограничиваем длину генерации
     }
-    
-    # Настройка безопасного соединения
-    connector = aiohttp.TCPConnector(
-        ssl=ssl.create_default_context(cafile=certifi.where())
-    )
-    
-    timeout = aiohttp.ClientTimeout(total=30)
-    
-    for attempt in range(3):  # Делаем 3 попытки
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов в тексте: для русского текста около трех символов на токен"""
+    return (len(text) + 2) // 3
+
+async def _request_choices(data: dict) -> list[str]:
+    """Выполняет запрос к модели с повторными попытками и возвращает тексты всех вариантов ответа"""
+    try:
+        result = await llm_retry_policy.run(
+            lambda: llm_client.post_json_hedged(data),
+            classify_llm_error,
+            breaker=llm_breaker,
+            name="LLM",
+        )
+        texts = [
+            choice['message']['content'].strip()
+            for choice in result['choices']
+            if choice.get('message', {}).get('content')
+        ]
+        logger.info("Текст успешно сгенерирован")
+        return texts
+    except CircuitOpenError as e:
+        logger.error(f"Генерация пропущена: {e}")
+    except asyncio.TimeoutError:
+        logger.error("Таймаут запроса к модели")
+    except Exception as e:
+        logger.error(f"Ошибка генерации: {e}")
+    return []
+
+async def _sample_alternatives(data: dict, count: int) -> list[str]:
+    """Получает count дополнительных вариантов параллельными запросами"""
+    if count <= 0:
+        return []
+    results = await asyncio.gather(*(_request_choices(data) for _ in range(count)))
+    return [texts[0] for texts in results if texts]
+
+async def generate_post_text(prompt: str, service_type: str = "manicure_pedicure", season: str | None = None) -> str | None:
+    texts = await generate_post_texts(prompt, service_type, season, n=1)
+    return texts[0] if texts else None
+
+async def generate_post_texts(prompt: str, service_type: str = "manicure_pedicure", season: str | None = None, n: int = 1) -> list[str]:
+    """Генерирует до n вариантов поста: через параметр n в одном запросе или параллельными запросами"""
+    # Проверяем наличие API ключа перед выполнением запроса
+    if not AI_API_KEY:
+        logger.error("AI_API_KEY не установлен в .env файле")
+        return []
+
+    data = _build_payload(prompt, season)
+    if n <= 1:
+        return (await _request_choices(data))[:1]
+    if config.AI_USE_N_PARAMETER:
+        return (await _request_choices({**data, "n": n}))[:n]
+    texts, extra = await asyncio.gather(_request_choices(data), _sample_alternatives(data, n - 1))
+    return texts[:1] + extra
+
+async def generate_post_texts_stream(
+    prompt: str,
+    service_type: str = "manicure_pedicure",
+    season: str | None = None,
+    on_text: Callable[[str], Awaitable[None]] | None = None,
+    n: int = 1,
+) -> list[str]:
+    """Генерирует до n вариантов поста; первый приходит потоком и передается в on_text по мере прихода токенов"""
+    if not AI_API_KEY:
+        logger.error("AI_API_KEY не установлен в .env файле")
+        return []
+
+    data = _build_payload(prompt, season)
+    use_n = n > 1 and config.AI_USE_N_PARAMETER
+    if use_n:
+        data = {**data, "n": n}
+    # Без поддержки n остальные варианты запрашиваем параллельно с потоком
+    extra_task = None
+    if n > 1 and not use_n:
+        extra_task = asyncio.create_task(_sample_alternatives(_build_payload(prompt, season), n - 1))
+
+    parts: dict[int, list[str]] = {}
+    try:
         try:
-            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                async with session.post(AI_BASE_URL, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        text = result['choices'][0]['message']['content']
-                        logger.info("Текст успешно сгенерирован")
-                        # Очищаем временные объекты
-                        del result
-                        return text.strip()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка API {response.status}: {error_text[:200]}...")
-                        if attempt == 2:  # Если последняя попытка
-                            return None
-                        await asyncio.sleep(2)  # Задержка перед повторной попыткой
-        except asyncio.TimeoutError:
-            logger.error(f"Таймаут запроса (попытка {attempt + 1}/3)")
-            if attempt == 2:  # Если последняя попытка
-                return None
-            await asyncio.sleep(2)  # Задержка перед повторной попыткой
+            # При разомкнутом предохранителе поток не открываем - сразу уходим в обычный путь, который ответит отказом
+            llm_breaker.before_call()
+            async for chunk in llm_client.stream_chat_hedged(data):
+                for choice in chunk.get('choices') or []:
+                    delta = choice.get('delta', {}).get('content')
+                    if not delta:
+                        continue
+                    index = choice.get('index', 0)
+                    parts.setdefault(index, []).append(delta)
+                    if index == 0 and on_text:
+                        await on_text("".join(parts[0]))
+            llm_breaker.record_success()
         except Exception as e:
-            logger.error(f"Ошибка сети (попытка {attempt + 1}/3): {e}")
-            if attempt == 2:  # Если последняя попытка
-                return None
-            await asyncio.sleep(2)  # Задержка перед повторной попыткой
-    return None
\ No newline at end of file
+            logger.warning(f"Потоковая генерация не удалась: {e}")
+            if not isinstance(e, CircuitOpenError):
+                if classify_llm_error(e).counts_as_failure:
+                    llm_breaker.record_failure()
+                else:
+                    llm_breaker.record_success()
+            parts = {}
+
+        texts = [text for text in ("".join(parts[index]).strip() for index in sorted(parts)) if text]
+        if not texts:
+            # Поток оборвался или пуст - переходим на обычную генерацию с повторными попытками
+            logger.warning("Переключаемся на обычный запрос")
+            if extra_task:
+                extra_task.cancel()
+            return await generate_post_texts(prompt, service_type, season, n=n)
+        logger.info("Текст успешно сгенерирован (поток)")
+        if extra_task:
+            texts += await extra_task
+        return texts[:n]
+    finally:
+        # Не оставляем фоновые запросы при отмене генерации
+        if extra_task and not extra_task.done():
+            extra_task.cancel()
@@ -0,0 +1,145 @@
+# 1. Сначала — загрузка .env
+from dotenv import load_dotenv
+load_dotenv()
+
+# 2. Теперь — все остальные импорты
+import argparse
+import asyncio
+import hashlib
+import logging
+import time
+
+import config
+from content_generator import build_template_prompt, build_topic_prompt, generate_post_text, get_service_type, llm_client
+from dedup import DuplicateIndex, duplicate_index
+from drafts_store import draft_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DUPLICATE_RETRIES = 2  # Сколько раз перегенерировать пост, похожий на уже написанный
+
+
+def build_jobs(count: int, topics: list[str], templates: list[str]) -> list[tuple[str | None, str | None]]:
+    """Раскладывает count постов по кругу между шаблонами и темами: [(template_key, topic), ...]"""
+    subjects = [(key, None) for key in templates] + [(None, topic) for topic in topics]
+    if not subjects:
+        return []
+    return [subjects[i % len(subjects)] for i in range(count)]
+
+
+def default_plan_id(jobs: list[tuple[str | None, str | None]], season: str) -> str:
+    """Одинаковые параметры запуска дают тот же план - так повторный запуск продолжает прерванный"""
+    digest = hashlib.sha1(repr((jobs, season)).encode("utf-8")).hexdigest()[:10]
+    return f"plan-{digest}"
+
+
+async def generate_draft(template_key: str | None, topic: str | None, season: str, plan_index: DuplicateIndex) -> str | None:
+    """Генерирует черновик, избегая повторов среди опубликованных постов и черновиков этого плана"""
+    if template_key:
+        prompt = build_template_prompt(template_key)
+        service_type = get_service_type(template_key)
+    else:
+        prompt = build_topic_prompt(topic, season)
+        service_type = "manicure_pedicure"
+    if not prompt:
+        logger.error(f"Неизвестный шаблон: {template_key}")
+        return None
+
+    for _ in range(DUPLICATE_RETRIES + 1):
+        text = await generate_post_text(prompt, service_type, season=season)
+        if not text:
+            return None
+        # Проверка и добавление в индекс плана идут без await между ними: параллельные воркеры
+        # не могут одновременно пропустить два похожих черновика - второй уже увидит первый
+        if not duplicate_index.is_duplicate(text) and not plan_index.find_similar(text):
+            plan_index.add(text, kind="planned")
+            return text
+        logger.info(f"Черновик похож на уже написанный, генерируем заново ({template_key or topic})")
+    logger.warning(f"Все {DUPLICATE_RETRIES + 1} попытки дали похожие черновики, пропускаем ({template_key or topic})")
+    return None
+
+
+async def run_plan(count: int, topics: list[str], templates: list[str], concurrency: int, plan_id: str | None = None):
+    season = config.get_current_season()
+    jobs = build_jobs(count, topics, templates)
+    plan_id = plan_id or default_plan_id(jobs, season)
+    job_keys = [f"{plan_id}:{i:03d}" for i in range(len(jobs))]
+
+    done = draft_store.done_job_keys(plan_id)
+    pending = [(key, job) for key, job in zip(job_keys, jobs) if key not in done]
+    logger.info(f"Контент-план {plan_id}: {len(jobs)} постов, уже готово {len(jobs) - len(pending)}, осталось {len(pending)}")
+    if not pending:
+        return
+
+    # Черновики плана сравниваем между собой отдельно от индекса опубликованных постов
+    plan_index = DuplicateIndex(path=":memory:")
+    for text in draft_store.plan_texts(plan_id):
+        plan_index.add(text, kind="planned")
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    completed = 0
+    failed = 0
+    started = time.perf_counter()
+
+    async def worker(job_key: str, template_key: str | None, topic: str | None):
+        nonlocal completed, failed
+        async with semaphore:
+            try:
+                text = await generate_draft(template_key, topic, season, plan_index)
+            except Exception as e:
+                logger.error(f"Ошибка генерации {job_key}: {e}")
+                text = None
+        if not text:
+            failed += 1
+            return
+        # Сохраняем сразу, чтобы после прерывания не генерировать этот пост заново
+        draft_store.add(job_key, plan_id, text, template_key=template_key, topic=topic, season=season)
+        completed += 1
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"[{completed + failed}/{len(pending)}] {job_key} ({template_key or topic}) готов, "
+            f"{completed / elapsed * 60:.1f} постов/мин"
+        )
+
+    await llm_client.start()
+    try:
+        await asyncio.gather(*(worker(key, template_key, topic) for key, (template_key, topic) in pending))
+    finally:
+        await llm_client.close()
+        plan_index.close()
+
+    elapsed = time.perf_counter() - started
+    rate = completed / elapsed * 60 if elapsed else 0.0
+    logger.info(
+        f"Контент-план {plan_id}: сгенерировано {completed}, ошибок {failed} за {elapsed:.1f} с "
+        f"({rate:.1f} постов/мин, параллельно {concurrency}). Готово к публикации: {draft_store.count_ready(season)}"
+    )
+    if failed:
+        logger.info("Запустите команду повторно с теми же параметрами, чтобы догенерировать оставшиеся посты")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная генерация контент-плана: черновики сохраняются, и бот предлагает их к публикации")
+    parser.add_argument("--count", type=int, default=30, help="Сколько постов сгенерировать (по умолчанию 30)")
+    parser.add_argument("--topics", nargs="*", default=[], help="Темы постов в дополнение к шаблонам")
+    parser.add_argument(
+        "--templates", nargs="*", choices=list(config.POST_TEMPLATES), default=None,
+        help="Шаблоны из config.POST_TEMPLATES (по умолчанию все)",
+    )
+    parser.add_argument("--concurrency", type=int, default=config.CONTENT_PLAN_CONCURRENCY, help="Сколько запросов к модели выполнять одновременно")
+    parser.add_argument("--plan", default=None, help="Идентификатор плана; по умолчанию вычисляется из параметров запуска")
+    args = parser.parse_args()
+
+    templates = list(config.POST_TEMPLATES) if args.templates is None else args.templates
+    try:
+        asyncio.run(run_plan(args.count, args.topics, templates, args.concurrency, args.plan))
+    except KeyboardInterrupt:
+        logger.info("Прервано. Готовые черновики сохранены, повторный запуск продолжит план")
+    finally:
+        duplicate_index.close()
+        draft_store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import struct
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 64  # Длина MinHash-сигнатуры
+BANDS = 16  # LSH: сигнатура режется на полосы, совпадение хотя бы одной полосы дает кандидата
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3  # Шинглы из трех слов подряд
+_SIGNATURE_FORMAT = f"<{NUM_PERM}I"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _strip_boilerplate(text: str) -> str:
+    """Убирает контактный блок: он одинаковый во всех постах и завышал бы сходство"""
+    for line in config.CONTACT_BLOCK.splitlines():
+        line = line.strip()
+        if line:
+            text = text.replace(line, " ")
+    return text
+
+
+def shingles(text: str) -> set[str]:
+    """Разбивает текст на шинглы из нескольких слов подряд"""
+    words = _WORD_RE.findall(_strip_boilerplate(text).lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> tuple[int, ...] | None:
+    """Вычисляет MinHash-сигнатуру текста; None для пустого текста"""
+    grams = shingles(text)
+    if not grams:
+        return None
+    # Вместо NUM_PERM отдельных хеш-функций берем NUM_PERM 32-битных слов из одного SHAKE-дайджеста шингла:
+    # все циклы выполняются внутри hashlib/struct/min, поэтому сигнатура считается за доли миллисекунды
+    rows = [struct.unpack(_SIGNATURE_FORMAT, hashlib.shake_128(gram.encode("utf-8")).digest(NUM_PERM * 4)) for gram in grams]
+    return tuple(map(min, zip(*rows)))
+
+
+def similarity(sig_a: tuple[int, ...], sig_b: tuple[int, ...]) -> float:
+    """Оценка коэффициента Жаккара по доле совпавших позиций сигнатур"""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+
+def _band_keys(signature: tuple[int, ...]) -> list[int]:
+    return [hash(signature[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS)]
+
+
+class DuplicateIndex:
+    """Индекс похожих постов на MinHash + LSH с хранением сигнатур в SQLite"""
+
+    def __init__(self, path: str = config.DEDUP_INDEX_PATH, threshold: float = config.DEDUP_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._signatures: dict[int, tuple[tuple[int, ...], str, str, float]] = {}
+        self._buckets: list[dict[int, list[int]]] = [{} for _ in range(BANDS)]
+        self._conn: sqlite3.Connection | None = None
+        self.checks = 0
+        self.rejected = 0  # Тексты, отброшенные как похожие (find_similar сам ничего не отбрасывает и сюда не считается)
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+                "signature BLOB NOT NULL, preview TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._load()
+        return self._conn
+
+    def _load(self):
+        assert self._conn is not None
+        started = time.perf_counter()
+        for post_id, kind, blob, preview, created_at in self._conn.execute(
+            "SELECT id, kind, signature, preview, created_at FROM posts"
+        ):
+            self._insert(post_id, struct.unpack(_SIGNATURE_FORMAT, blob), kind, preview, created_at)
+        logger.info(
+            f"Duplicate index loaded: {len(self._signatures)} posts in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+
+    def _insert(self, post_id: int, signature: tuple[int, ...], kind: str, preview: str, created_at: float):
+        self._signatures[post_id] = (signature, kind, preview, created_at)
+        for band, key in zip(self._buckets, _band_keys(signature)):
+            band.setdefault(key, []).append(post_id)
+
+    def add(self, text: str, kind: str = "published"):
+        """Добавляет пост в индекс и сохраняет его сигнатуру на диск"""
+        if not self.enabled:
+            return
+        signature = minhash(text)
+        if signature is None:
+            return
+        conn = self._connect()
+        preview = text.strip().replace("\n", " ")[:80]
+        created_at = time.time()
+        cursor = conn.execute(
+            "INSERT INTO posts (kind, signature, preview, created_at) VALUES (?, ?, ?, ?)",
+            (kind, struct.pack(_SIGNATURE_FORMAT, *signature), preview, created_at),
+        )
+        conn.commit()
+        self._insert(cursor.lastrowid, signature, kind, preview, created_at)
+
+    def find_similar(self, text: str) -> tuple[float, str, str] | None:
+        """Ищет самый похожий пост в индексе: (сходство, вид, начало текста) или None, если похожих нет"""
+        if not self.enabled:
+            return None
+        self._connect()
+        signature = minhash(text)
+        if signature is None:
+            return None
+        self.checks += 1
+        candidates: set[int] = set()
+        for band, key in zip(self._buckets, _band_keys(signature)):
+            candidates.update(band.get(key, ()))
+        best = None
+        for post_id in candidates:
+            stored, kind, preview, _ = self._signatures[post_id]
+            score = similarity(signature, stored)
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, kind, preview)
+        return best
+
+    def is_duplicate(self, text: str) -> bool:
+        """Проверка перед тем, как отбросить текст: похожий пост есть - текст считается отброшенным"""
+        if self.find_similar(text) is None:
+            return False
+        self.rejected += 1
+        return True
+
+    def prefer_unique(self, texts: list[str]) -> list[str]:
+        """Отбрасывает варианты, похожие на уже опубликованные посты; если похожи все - оставляет как есть"""
+        if not self.enabled or not texts:
+            return texts
+        unique = [text for text in texts if self.find_similar(text) is None]
+        if not unique:
+            return texts
+        if len(unique) < len(texts):
+            self.rejected += len(texts) - len(unique)
+            logger.info(f"Отброшено вариантов-дубликатов: {len(texts) - len(unique)} из {len(texts)}")
+        return unique
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_stats(self) -> dict:
+        return {
+            "posts": len(self._signatures),
+            "checks": self.checks,
+            "rejected": self.rejected,
+        }
+
+
+duplicate_index = DuplicateIndex()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from collections import deque
+
+import config
+from content_generator import build_template_prompt, generate_post_text, get_service_type
+from dedup import duplicate_index
+
+logger = logging.getLogger(__name__)
+
+
+class DraftPool:
+    """Пул заранее сгенерированных черновиков для каждого шаблона из config.POST_TEMPLATES"""
+
+    def __init__(
+        self,
+        size: int = config.DRAFT_POOL_SIZE,
+        season_check_interval: int = config.DRAFT_POOL_SEASON_CHECK_INTERVAL,
+        retry_delay: int = 60,
+    ):
+        self.size = size
+        self.season_check_interval = season_check_interval
+        self.retry_delay = retry_delay
+        self._drafts: dict[str, deque[str]] = {key: deque() for key in config.POST_TEMPLATES}
+        self._season = config.get_current_season()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def _check_season(self):
+        # Черновики пишутся с учетом сезона - при смене сезона они устаревают
+        season = config.get_current_season()
+        if season != self._season:
+            dropped = sum(len(drafts) for drafts in self._drafts.values())
+            for drafts in self._drafts.values():
+                drafts.clear()
+            self._season = season
+            self.invalidations += 1
+            logger.info(f"Сезон сменился на '{season}', пул черновиков сброшен ({dropped} шт.)")
+            self._wakeup.set()
+
+    def take(self, template_key: str) -> str | None:
+        """Забирает готовый черновик для шаблона или возвращает None, если пул пуст"""
+        if not self.enabled:
+            return None
+        self._check_season()
+        drafts = self._drafts.get(template_key)
+        # В любом случае будим фоновую задачу, чтобы она дозаполнила пул
+        self._wakeup.set()
+        while drafts:
+            draft = drafts.popleft()
+            # Пока черновик ждал в пуле, похожий пост могли опубликовать
+            if duplicate_index.is_duplicate(draft):
+                continue
+            self.hits += 1
+            return draft
+        self.misses += 1
+        return None
+
+    async def _fill(self) -> bool:
+        """Дозаполняет пул до self.size черновиков на шаблон; возвращает False при ошибке генерации"""
+        for template_key, drafts in self._drafts.items():
+            while len(drafts) < self.size:
+                season = self._season
+                prompt = build_template_prompt(template_key)
+                if not prompt:
+                    break
+                text = await generate_post_text(prompt, get_service_type(template_key), season=season)
+                if not text:
+                    return False
+                # Пока шла генерация, сезон мог смениться - такой черновик уже не нужен
+                if season != self._season:
+                    continue
+                drafts.append(text)
+                self.generated += 1
+        return True
+
+    async def _run(self):
+        logger.info(f"Draft pool warmer started: {self.size} drafts per template")
+        while True:
+            self._wakeup.clear()
+            self._check_season()
+            try:
+                filled = await self._fill()
+            except Exception as e:
+                logger.error(f"Ошибка при заполнении пула черновиков: {e}")
+                filled = False
+            if not filled:
+                # Провайдер недоступен - не долбим его, а ждем перед следующей попыткой
+                await asyncio.sleep(self.retry_delay)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.season_check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Запускает фоновое заполнение пула"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновое заполнение пула"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info(f"Draft pool stopped. Stats: {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        """Возвращает счетчики попаданий/промахов и текущий размер пула"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 2) if total else None,
+            "generated": self.generated,
+            "invalidations": self.invalidations,
+            "ready": {key: len(drafts) for key, drafts in self._drafts.items()},
+            "season": self._season,
+        }
+
+
+draft_pool = DraftPool()
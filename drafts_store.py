@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import time
+
+import config
+
+# Черновики без сезона сохранены до того, как он стал записываться, - их отдаем в любой сезон
+_SEASON_FILTER = "(season = ? OR season IS NULL)"
+
+
+class DraftStore:
+    """Локальное хранилище черновиков контент-плана (SQLite), из которого бот предлагает посты к публикации"""
+
+    def __init__(self, path: str = config.DRAFTS_DB_PATH):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")  # Бот читает, пока CLI пишет
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS drafts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "job_key TEXT NOT NULL UNIQUE, "
+                "plan_id TEXT NOT NULL, "
+                "template_key TEXT, "
+                "topic TEXT, "
+                "text TEXT NOT NULL, "
+                "season TEXT, "
+                "status TEXT NOT NULL DEFAULT 'ready', "
+                "created_at REAL NOT NULL)"
+            )
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(drafts)")}
+            if "season" not in columns:
+                self._conn.execute("ALTER TABLE drafts ADD COLUMN season TEXT")
+            self._conn.commit()
+        return self._conn
+
+    def done_job_keys(self, plan_id: str) -> set[str]:
+        """Ключи задач плана, для которых черновик уже сохранен (для продолжения после прерывания)"""
+        rows = self._connect().execute("SELECT job_key FROM drafts WHERE plan_id = ?", (plan_id,))
+        return {row["job_key"] for row in rows}
+
+    def plan_texts(self, plan_id: str) -> list[str]:
+        """Тексты уже сохраненных черновиков плана"""
+        rows = self._connect().execute("SELECT text FROM drafts WHERE plan_id = ?", (plan_id,))
+        return [row["text"] for row in rows]
+
+    def add(
+        self,
+        job_key: str,
+        plan_id: str,
+        text: str,
+        template_key: str | None = None,
+        topic: str | None = None,
+        season: str | None = None,
+    ):
+        """Сохраняет готовый черновик; повторная запись той же задачи игнорируется"""
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR IGNORE INTO drafts (job_key, plan_id, template_key, topic, text, season, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_key, plan_id, template_key, topic, text, season, time.time()),
+        )
+        conn.commit()
+
+    def take_next(self, season: str) -> sqlite3.Row | None:
+        """Забирает самый старый готовый черновик для сезона season и помечает его выданным"""
+        conn = self._connect()
+        row = conn.execute(
+            f"SELECT * FROM drafts WHERE status = 'ready' AND {_SEASON_FILTER} ORDER BY id LIMIT 1", (season,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE drafts SET status = 'taken' WHERE id = ?", (row["id"],))
+        conn.commit()
+        return row
+
+    def count_ready(self, season: str) -> int:
+        return self._connect().execute(
+            f"SELECT COUNT(*) FROM drafts WHERE status = 'ready' AND {_SEASON_FILTER}", (season,)
+        ).fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+draft_store = DraftStore()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _key_id(key: StorageKey) -> str:
+    return ":".join(
+        str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+    )
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite: черновики переживают перезапуск бота.
+
+    Чтение идет из словаря в памяти, запись сначала меняет словарь, а на диск изменения
+    уходят пачкой раз в flush_interval_ms (и при закрытии).
+    """
+
+    def __init__(self, path: str = config.FSM_DB_PATH, flush_interval_ms: int = config.FSM_FLUSH_INTERVAL_MS):
+        self.path = path
+        self.flush_interval = flush_interval_ms / 1000
+        self._conn: sqlite3.Connection | None = None
+        self._records: dict[StorageKey, tuple[str | None, dict[str, Any]]] = {}
+        self._dirty: set[StorageKey] = set()
+        self._flush_task: asyncio.Task | None = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                "key TEXT PRIMARY KEY, "
+                "state TEXT, "
+                "data TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _record(self, key: StorageKey) -> tuple[str | None, dict[str, Any]]:
+        """Запись из памяти; с диска читается только первый раз для ключа"""
+        record = self._records.get(key)
+        if record is None:
+            row = self._connect().execute("SELECT state, data FROM fsm WHERE key = ?", (_key_id(key),)).fetchone()
+            record = (row[0], json.loads(row[1])) if row else (None, {})
+            self._records[key] = record
+        return record
+
+    def _write(self, key: StorageKey, state: str | None, data: dict[str, Any]):
+        self._records[key] = (state, data)
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """Записывает на диск все изменения, накопленные с прошлой записи, одной транзакцией"""
+        if not self._dirty:
+            return
+        upserts, deletes = [], []
+        for key in self._dirty:
+            state, data = self._records[key]
+            key_id = _key_id(key)
+            if state is None and not data:
+                deletes.append((key_id,))
+                continue
+            try:
+                upserts.append((key_id, state, json.dumps(data, ensure_ascii=False)))
+            except (TypeError, ValueError) as e:
+                logger.error(f"FSM data for {key_id} is not JSON-serializable, keeping it in memory only: {e}")
+        self._dirty.clear()
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO fsm (key, state, data) VALUES (?, ?, ?)", upserts)
+            conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+        self.flushes += 1
+        self.rows_written += len(upserts) + len(deletes)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(key, state.state if isinstance(state, State) else state, self._record(key)[1])
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._record(key)[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        self._write(key, self._record(key)[0], data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return self._record(key)[1].copy()
+
+    async def close(self) -> None:
+        """Сбрасывает несохраненные изменения на диск; вызывается диспетчером при остановке"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._conn is not None or self._dirty:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+            logger.info(f"FSM storage closed. Stats: {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        return {
+            "keys": len(self._records),
+            "pending": len(self._dirty),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, TypeVar
+
+from content_generator import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class GenerationCancelled(Exception):
+    """Генерация отменена более новым действием в том же чате - ее результат никуда не пишется"""
+
+
+class _Generation:
+    def __init__(self, task: asyncio.Task, token_budget: int, on_cancel: Callable[[], None] | None):
+        self.task = task
+        self.on_cancel = on_cancel
+        self.token_budget = token_budget  # Сколько токенов ответа генерация может потратить
+        self.text = ""  # Уже полученный потоком текст
+        self.superseded = False
+
+
+class GenerationTracker:
+    """Текущая генерация каждого чата в отдельной задаче: новое действие отменяет старую вместе с HTTP-запросом к модели"""
+
+    def __init__(self):
+        self._running: dict[int, _Generation] = {}
+        self.started = 0
+        self.cancelled = 0
+        self.tokens_saved = 0  # Оценка: лимит токенов ответа минус уже полученный текст
+
+    async def run(self, chat_id: int, coro: Awaitable[T], token_budget: int, on_cancel: Callable[[], None] | None = None) -> T:
+        """Запускает генерацию для чата, отменив предыдущую; GenerationCancelled - если ее саму отменили.
+
+        on_cancel вызывается сразу при отмене, до остановки задачи (например, чтобы бросить отложенные правки сообщения).
+        """
+        await self.cancel(chat_id)
+        generation = _Generation(asyncio.ensure_future(coro), token_budget, on_cancel)
+        self._running[chat_id] = generation
+        self.started += 1
+        try:
+            # Отмена обработчика (например, при остановке бота) отменяет и задачу генерации
+            return await generation.task
+        except asyncio.CancelledError:
+            if generation.superseded:
+                raise GenerationCancelled() from None
+            raise
+        finally:
+            if self._running.get(chat_id) is generation:
+                del self._running[chat_id]
+
+    def progress(self, chat_id: int, text: str):
+        """Запоминает текст, уже полученный потоком, - для оценки сэкономленных токенов"""
+        generation = self._running.get(chat_id)
+        if generation is not None:
+            generation.text = text
+
+    async def cancel(self, chat_id: int) -> bool:
+        """Отменяет идущую генерацию чата и дожидается, пока она остановится"""
+        generation = self._running.pop(chat_id, None)
+        if generation is None or generation.task.done():
+            return False
+        generation.superseded = True
+        if generation.on_cancel is not None:
+            generation.on_cancel()
+        generation.task.cancel()
+        await asyncio.gather(generation.task, return_exceptions=True)
+        saved = max(0, generation.token_budget - estimate_tokens(generation.text))
+        self.cancelled += 1
+        self.tokens_saved += saved
+        logger.info(f"Cancelled generation in chat {chat_id}, ~{saved} tokens saved")
+        return True
+
+    def get_stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "started": self.started,
+            "cancelled": self.cancelled,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+generation_tracker = GenerationTracker()
@@ -0,0 +1,93 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow необязателен: без него фото загружаются как есть
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+
+def shrink_image(data: bytes, max_edge: int, quality: int) -> bytes:
+    """Уменьшает фото до max_edge по большей стороне, убирает EXIF и пережимает в JPEG (выполняется в отдельном процессе)"""
+    with Image.open(io.BytesIO(data)) as image:
+        # Поворот из EXIF применяем к пикселям, иначе после удаления EXIF фото окажется повернутым
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if max_edge > 0 and max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        # Новый файл сохраняется без EXIF и прочих метаданных
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class ImageProcessor:
+    """Обработка фото перед загрузкой в VK в пуле процессов, чтобы не блокировать цикл событий"""
+
+    def __init__(
+        self,
+        enabled: bool = config.IMAGE_PROCESSING,
+        min_size_kb: int = config.IMAGE_MIN_SIZE_KB,
+        max_edge: int = config.IMAGE_MAX_EDGE,
+        quality: int = config.IMAGE_JPEG_QUALITY,
+        workers: int = config.IMAGE_WORKERS,
+    ):
+        self.enabled = enabled and Image is not None
+        if enabled and Image is None:
+            logger.warning("IMAGE_PROCESSING is enabled, but Pillow is not installed (pip install -r requirements.txt): photos are uploaded to VK without resizing")
+        self.min_size = min_size_kb * 1024
+        self.max_edge = max_edge
+        self.quality = quality
+        self.workers = max(1, workers)
+        self._executor: ProcessPoolExecutor | None = None
+        # Фото, ожидающее обработки, целиком лежит в памяти - ограничиваем их число числом процессов
+        self.slots = asyncio.Semaphore(self.workers)
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def process(self, data: bytes) -> bytes:
+        """Возвращает обработанное фото; если обработка не удалась или не уменьшила файл - исходное"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._executor, shrink_image, data, self.max_edge, self.quality)
+        except Exception as e:
+            logger.warning(f"Failed to process image, uploading original: {e}")
+            return data
+        self.processed += 1
+        self.bytes_in += len(data)
+        if len(result) >= len(data):
+            # Исходник уже сжат лучше - пережатый JPEG не нужен
+            result = data
+        self.bytes_out += len(result)
+        return result
+
+    def should_process(self, file_size: int | None) -> bool:
+        """Пережимать ли фото такого размера; мелкие (и с неизвестным размером) передаются как есть"""
+        return self.enabled and file_size is not None and file_size >= self.min_size
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "processed": self.processed,
+            "mb_in": round(self.bytes_in / 1e6, 1),
+            "mb_out": round(self.bytes_out / 1e6, 1),
+        }
+
+
+image_processor = ImageProcessor()
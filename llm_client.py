@@ -0,0 +1,397 @@
+import asyncio
+import json
+import logging
+import ssl
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+import aiohttp
+import certifi
+
+import config
+from retry import CircuitOpenError, RetryDecision
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def get_ssl_context() -> ssl.SSLContext:
+    """Возвращает SSL-контекст с сертификатами certifi (создается один раз за процесс)"""
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+class LLMAPIError(Exception):
+    """Ошибка ответа LLM-провайдера (статус отличный от 200)"""
+
+    def __init__(self, status: int, text: str, retry_after: float | None = None):
+        super().__init__(f"Ошибка API {status}: {text[:200]}")
+        self.status = status
+        self.text = text
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Разбирает заголовок Retry-After: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# Статусы, при которых повтор может помочь: таймауты, лимиты и сбои на стороне провайдера
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def classify_llm_error(error: BaseException) -> RetryDecision:
+    """Определяет, стоит ли повторять запрос к LLM после ошибки"""
+    if isinstance(error, CircuitOpenError):
+        return RetryDecision(retryable=False, counts_as_failure=False)
+    if isinstance(error, LLMAPIError):
+        if error.status == 429:
+            # Провайдер жив, просто просит притормозить
+            return RetryDecision(retryable=True, counts_as_failure=False, retry_after=error.retry_after)
+        if error.status in RETRYABLE_STATUSES or error.status >= 500:
+            return RetryDecision(retryable=True, retry_after=error.retry_after)
+        # Остальные 4xx (неверный ключ, модель, запрос) повторять бессмысленно
+        return RetryDecision(retryable=False, counts_as_failure=False)
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+        return RetryDecision(retryable=True)
+    # Неожиданный формат ответа и прочие ошибки - не повторяем
+    return RetryDecision(retryable=False, counts_as_failure=False)
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек для расчета перцентилей"""
+
+    def __init__(self, window: int = config.AI_HEDGE_WINDOW):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, elapsed_ms: float):
+        self._samples.append(elapsed_ms)
+
+    def percentile(self, p: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class LLMProvider:
+    """Адрес, ключ и модель LLM-провайдера со статистикой задержек"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: str):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.latency = LatencyTracker()  # Полные ответы
+        self.first_token_latency = LatencyTracker()  # Время до первого чанка потока
+
+    @property
+    def headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "User-Agent": "ValeriaBot/1.0",
+        }
+
+    def get_stats(self) -> dict:
+        def rounded(value: float | None) -> float | None:
+            return round(value, 1) if value is not None else None
+
+        return {
+            "model": self.model,
+            "samples": len(self.latency),
+            "p50_ms": rounded(self.latency.percentile(50)),
+            "p90_ms": rounded(self.latency.percentile(90)),
+            "first_token_p90_ms": rounded(self.first_token_latency.percentile(90)),
+        }
+
+
+class LLMClient:
+    """Долгоживущий HTTP-клиент для LLM-провайдера с пулом keep-alive соединений"""
+
+    def __init__(
+        self,
+        primary: LLMProvider | None = None,
+        fallback: LLMProvider | None = None,
+        limit: int = config.AI_POOL_LIMIT,
+        limit_per_host: int = config.AI_POOL_LIMIT_PER_HOST,
+        keepalive_timeout: int = config.AI_KEEPALIVE_TIMEOUT,
+        request_timeout: int = config.AI_REQUEST_TIMEOUT,
+    ):
+        self.primary = primary or LLMProvider("primary", config.AI_BASE_URL, config.AI_API_KEY, config.AI_MODEL)
+        self.fallback = fallback
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self._session: aiohttp.ClientSession | None = None
+        self._lock = asyncio.Lock()
+        # Статистика задержек: "холодные" запросы открывали новое соединение, "теплые" взяли его из пула
+        self._stats = {
+            "cold_requests": 0,
+            "cold_total_ms": 0.0,
+            "warm_requests": 0,
+            "warm_total_ms": 0.0,
+            "stream_requests": 0,
+            "first_token_total_ms": 0.0,
+            "hedged_requests": 0,
+            "hedge_wins": 0,
+        }
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            ssl=get_ssl_context(),
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300,  # Кэшируем DNS, чтобы не резолвить хост на каждый запрос
+        )
+
+        # Отмечаем запросы, которым пришлось открыть новое TCP/TLS соединение
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_connection_create_end(session, trace_config_ctx, params):
+            if trace_config_ctx.trace_request_ctx is not None:
+                trace_config_ctx.trace_request_ctx["cold"] = True
+
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            trace_configs=[trace_config],
+        )
+
+    async def start(self):
+        """Создает сессию и пул соединений (вызывается при старте бота)"""
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                self._session = self._create_session()
+                logger.info(
+                    f"LLM client started: pool limit={self.limit}, per host={self.limit_per_host}, "
+                    f"keepalive={self.keepalive_timeout}s"
+                )
+
+    async def close(self):
+        """Закрывает сессию и все соединения пула"""
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+                logger.info(f"LLM client closed. Stats: {self.get_stats()}")
+            self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Ленивая инициализация на случай использования клиента без явного start()
+        if self._session is None or self._session.closed:
+            await self.start()
+        assert self._session is not None
+        return self._session
+
+    def _record_latency(self, cold: bool, elapsed_ms: float):
+        kind = "cold" if cold else "warm"
+        self._stats[f"{kind}_requests"] += 1
+        self._stats[f"{kind}_total_ms"] += elapsed_ms
+
+    async def post_json(self, payload: dict, provider: LLMProvider | None = None) -> dict:
+        """Отправляет запрос chat completions и возвращает JSON ответа"""
+        provider = provider or self.primary
+        session = await self._get_session()
+        trace_ctx = {"cold": False}
+        started = time.perf_counter()
+        async with session.post(
+            provider.base_url,
+            headers=provider.headers,
+            json={**payload, "model": provider.model},
+            trace_request_ctx=trace_ctx,
+        ) as response:
+            if response.status != 200:
+                raise LLMAPIError(response.status, await response.text(), parse_retry_after(response.headers.get("Retry-After")))
+            result = await response.json()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._record_latency(trace_ctx["cold"], elapsed_ms)
+        provider.latency.record(elapsed_ms)
+        return result
+
+    async def stream_chat(self, payload: dict, provider: LLMProvider | None = None):
+        """Отправляет потоковый запрос chat completions и отдает разобранные SSE-чанки по мере поступления"""
+        provider = provider or self.primary
+        session = await self._get_session()
+        trace_ctx = {"cold": False}
+        started = time.perf_counter()
+        first_chunk = True
+        async with session.post(
+            provider.base_url,
+            headers=provider.headers,
+            json={**payload, "model": provider.model, "stream": True},
+            trace_request_ctx=trace_ctx,
+        ) as response:
+            if response.status != 200:
+                raise LLMAPIError(response.status, await response.text(), parse_retry_after(response.headers.get("Retry-After")))
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                # Пропускаем пустые строки и SSE-комментарии (OpenRouter шлет ": OPENROUTER PROCESSING")
+                if not line or line.startswith(":") or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.warning(f"Не удалось разобрать SSE-чанк: {data[:200]}")
+                    continue
+                if "error" in chunk:
+                    raise LLMAPIError(500, json.dumps(chunk["error"], ensure_ascii=False))
+                if first_chunk:
+                    # Для потока задержкой запроса считаем время до первого чанка
+                    first_chunk = False
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    self._record_latency(trace_ctx["cold"], elapsed_ms)
+                    self._stats["stream_requests"] += 1
+                    self._stats["first_token_total_ms"] += elapsed_ms
+                    provider.first_token_latency.record(elapsed_ms)
+                yield chunk
+
+    @property
+    def has_distinct_fallback(self) -> bool:
+        """Задан ли запасной провайдер, отличный от основного (без AI_FALLBACK_* запасной совпадает с основным)"""
+        fallback = self.fallback
+        return fallback is not None and (fallback.base_url, fallback.api_key, fallback.model) != (
+            self.primary.base_url, self.primary.api_key, self.primary.model
+        )
+
+    def hedge_delay(self, tracker: LatencyTracker) -> float:
+        """Через сколько секунд без ответа отправлять запасной запрос (p90 задержки основного провайдера)"""
+        p90 = tracker.percentile(90) if len(tracker) >= config.AI_HEDGE_MIN_SAMPLES else None
+        delay_ms = p90 if p90 is not None else config.AI_HEDGE_DEFAULT_MS
+        return max(delay_ms, config.AI_HEDGE_MIN_MS) / 1000
+
+    async def _race(self, start, tracker: LatencyTracker, tasks: list[asyncio.Task]) -> asyncio.Task:
+        """Запускает start(основной провайдер), а если он не уложился в hedge_delay - еще и start(запасной).
+        Возвращает первую успешно завершившуюся задачу; все задачи складываются в tasks, чтобы вызывающий код отменил проигравшую"""
+        secondary = self.fallback or self.primary
+        tasks.append(asyncio.create_task(start(self.primary)))
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(tracker))
+        if done:
+            error = tasks[0].exception()
+            if error is None:
+                return tasks[0]
+            # Быстрая ошибка - не повод для хеджирования: тот же провайдер ответил бы так же (429 надо переждать
+            # по Retry-After в RetryPolicy, а 4xx - платный повтор впустую). Сразу идем только к другому провайдеру
+            if not self.has_distinct_fallback or not classify_llm_error(error).retryable:
+                raise error
+        # Основной провайдер завис или ответил временной ошибкой - подключаем запасной
+        logger.info(f"Hedging LLM request to {secondary.name} ({secondary.model})")
+        self._stats["hedged_requests"] += 1
+        tasks.append(asyncio.create_task(start(secondary)))
+        pending = {task for task in tasks if not task.done()}
+        last_error = tasks[0].exception() if tasks[0].done() else None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is tasks[1]:
+                        self._stats["hedge_wins"] += 1
+                    return task
+                last_error = task.exception()
+        assert last_error is not None
+        raise last_error
+
+    async def post_json_hedged(self, payload: dict) -> dict:
+        """Запрос с хеджированием: если основной провайдер не ответил за p90, параллельно уходит запасной запрос"""
+        if not config.AI_HEDGING:
+            return await self.post_json(payload)
+
+        async def start(provider: LLMProvider):
+            return await self.post_json(payload, provider)
+
+        tasks: list[asyncio.Task] = []
+        try:
+            winner = await self._race(start, self.primary.latency, tasks)
+            return winner.result()
+        finally:
+            # Отменяем проигравший запрос - соединение с ним закрывается
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _open_stream(self, payload: dict, provider: LLMProvider):
+        """Открывает поток и дожидается первого чанка"""
+        stream = self.stream_chat(payload, provider)
+        try:
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+        except BaseException:
+            await stream.aclose()
+            raise
+
+    async def stream_chat_hedged(self, payload: dict):
+        """Потоковый запрос с хеджированием по времени до первого чанка"""
+        if not config.AI_HEDGING:
+            async for chunk in self.stream_chat(payload):
+                yield chunk
+            return
+
+        async def start(provider: LLMProvider):
+            return await self._open_stream(payload, provider)
+
+        tasks: list[asyncio.Task] = []
+        winner = None
+        try:
+            winner = await self._race(start, self.primary.first_token_latency, tasks)
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # Проигравший поток уже успел открыться - закрываем его
+                    await task.result()[0].aclose()
+
+        stream, first = winner.result()
+        try:
+            if first is None:
+                return
+            yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def get_stats(self) -> dict:
+        """Возвращает задержки холодных/теплых запросов, время до первого токена и статистику хеджирования"""
+        stats = self._stats
+        cold_avg = stats["cold_total_ms"] / stats["cold_requests"] if stats["cold_requests"] else None
+        warm_avg = stats["warm_total_ms"] / stats["warm_requests"] if stats["warm_requests"] else None
+        providers = {self.primary.name: self.primary.get_stats()}
+        if self.fallback:
+            providers[self.fallback.name] = self.fallback.get_stats()
+        return {
+            "cold_requests": stats["cold_requests"],
+            "warm_requests": stats["warm_requests"],
+            "cold_avg_ms": round(cold_avg, 1) if cold_avg is not None else None,
+            "warm_avg_ms": round(warm_avg, 1) if warm_avg is not None else None,
+            "saved_per_request_ms": round(cold_avg - warm_avg, 1) if cold_avg is not None and warm_avg is not None else None,
+            "stream_requests": stats["stream_requests"],
+            "first_token_avg_ms": round(stats["first_token_total_ms"] / stats["stream_requests"], 1) if stats["stream_requests"] else None,
+            "hedged_requests": stats["hedged_requests"],
+            "hedge_wins": stats["hedge_wins"],
+            "providers": providers,
+        }
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from aiogram.types import Message
+
+import config
+from chat_queue import chat_serializer
+
+
+class MediaGroupCollector:
+    """Собирает альбом (сообщения с одним media_group_id), который Telegram присылает отдельными апдейтами"""
+
+    def __init__(self, debounce_ms: int = config.MEDIA_GROUP_DEBOUNCE_MS):
+        self.debounce = debounce_ms / 1000
+        self._groups: dict[tuple[int, str], list[Message]] = {}
+        self._last_seen: dict[tuple[int, str], float] = {}
+        self.albums = 0
+        self.collapsed = 0  # Сообщений, обработанных в составе альбома, а не по отдельности
+
+    async def collect(self, message: Message) -> list[Message] | None:
+        """Возвращает весь альбом первому обработчику (после паузы без новых фото), остальным - None; одиночное фото - сразу"""
+        if not message.media_group_id:
+            return [message]
+        key = (message.chat.id, message.media_group_id)
+        self._last_seen[key] = time.monotonic()
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(message)
+            return None
+        self._groups[key] = [message]
+        # Ждем, пока фото перестанут приходить: каждое новое продлевает ожидание.
+        # Очередь чата на это время отдаем, иначе остальные фото альбома ждали бы за этим обработчиком
+        async with chat_serializer.released():
+            while (wait := self._last_seen[key] + self.debounce - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+        del self._last_seen[key]
+        messages = sorted(self._groups.pop(key), key=lambda item: item.message_id)
+        self.albums += 1
+        self.collapsed += len(messages)
+        return messages
+
+    def get_stats(self) -> dict:
+        return {"albums": self.albums, "collapsed": self.collapsed}
+
+
+media_groups = MediaGroupCollector()
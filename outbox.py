@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from aiogram import Bot
+from aiogram.types import InputMediaPhoto
+
+import config
+from dedup import duplicate_index
+from publisher import DeliveryUnknown, publish_telegram_post, publish_vk_post
+from vk_publisher import find_wall_post
+from vk_preupload import photo_preuploader
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM = "telegram"
+VK = "vk"
+TARGET_NAMES = {TELEGRAM: "Telegram", VK: "VK"}
+UNKNOWN_ERROR = "Неизвестная ошибка"
+PREUPLOAD_KIND = "outbox"  # Ключи фоновых загрузок фото, переданных задаче публикации: (PREUPLOAD_KIND, job_id)
+CHECK_CHANNEL = "пост мог быть опубликован - проверьте канал"
+
+
+def _target_names(targets: list[str], separator: str = " и ") -> str:
+    return separator.join(TARGET_NAMES[target] for target in targets)
+
+
+class Outbox:
+    """Очередь публикаций в SQLite: пост сохраняется на диск до публикации, фоновая задача отправляет его в каждую площадку с повторами"""
+
+    def __init__(
+        self,
+        path: str = config.OUTBOX_DB_PATH,
+        max_attempts: int = config.OUTBOX_MAX_ATTEMPTS,
+        retry_delay: int = config.OUTBOX_RETRY_DELAY,
+        retry_max_delay: int = config.OUTBOX_RETRY_MAX_DELAY,
+        vk_guid_window: int = config.OUTBOX_VK_GUID_WINDOW,
+    ):
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.vk_guid_window = vk_guid_window
+        self._conn: sqlite3.Connection | None = None
+        self._bot: Bot | None = None
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.enqueued = 0
+        self.duplicates = 0  # Повторные постановки того же поста (например, двойное нажатие кнопки)
+        self.published = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "idempotency_key TEXT NOT NULL UNIQUE, "
+                "chat_id INTEGER, "
+                "message_id INTEGER, "
+                "text TEXT NOT NULL, "
+                "photos TEXT NOT NULL, "
+                "vk_attachments TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "created_at REAL NOT NULL, "
+                "finished_at REAL)"
+            )
+            # Статус каждой площадки отдельно: повторяется только та, где публикация не удалась
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS targets ("
+                "job_id INTEGER NOT NULL, "
+                "target TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL, "
+                "last_error TEXT, "
+                "first_sent_at REAL, "
+                "post_id INTEGER, "
+                "PRIMARY KEY (job_id, target))"
+            )
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(targets)")}
+            # first_sent_at - начало первой попытки, post_id - id опубликованного поста в VK
+            for column, column_type in (("first_sent_at", "REAL"), ("post_id", "INTEGER")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE targets ADD COLUMN {column} {column_type}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS targets_due ON targets (status, next_attempt_at)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Ключ идемпотентности из частей, однозначно описывающих публикацию"""
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+    @staticmethod
+    def preupload_key(job_id: int) -> tuple:
+        """Ключ, под которым задача публикации забирает фоновые загрузки фото в VK"""
+        return (PREUPLOAD_KIND, job_id)
+
+    def enqueue(
+        self,
+        key: str,
+        text: str,
+        photos: list[str],
+        vk_attachments: dict[str, str] | None = None,
+        chat_id: int | None = None,
+        message_id: int | None = None,
+    ) -> tuple[int, bool]:
+        """Сохраняет пост в очередь; возвращает (id задачи, False - если пост с этим ключом уже был поставлен)"""
+        targets = []
+        if config.TELEGRAM_CHANNEL_ID:
+            targets.append(TELEGRAM)
+        if config.VK_USER_TOKEN:
+            targets.append(VK)
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (idempotency_key, chat_id, message_id, text, photos, vk_attachments, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, chat_id, message_id, text, json.dumps(photos), json.dumps(vk_attachments or {}), now),
+            )
+            if cursor.rowcount == 0:
+                self.duplicates += 1
+                row = conn.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (key,)).fetchone()
+                return row["id"], False
+            job_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO targets (job_id, target, next_attempt_at) VALUES (?, ?, ?)",
+                [(job_id, target, now) for target in targets],
+            )
+        self.enqueued += 1
+        self._wakeup.set()
+        return job_id, True
+
+    def save_attachment(self, job_id: int, file_id: str, attachment: str):
+        """Дописывает в задачу вложение фото, догруженного в VK уже после постановки: после перезапуска его не загрузят снова"""
+        conn = self._connect()
+        row = conn.execute("SELECT vk_attachments FROM jobs WHERE id = ? AND status = 'pending'", (job_id,)).fetchone()
+        if row is None:
+            return
+        attachments = {**json.loads(row["vk_attachments"]), file_id: attachment}
+        with conn:
+            conn.execute("UPDATE jobs SET vk_attachments = ? WHERE id = ?", (json.dumps(attachments), job_id))
+
+    def count_pending(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def _recover(self):
+        """Разбирает публикации, прерванные перезапуском бота"""
+        conn = self._connect()
+        with conn:
+            # Повторный wall.post с тем же guid VK не опубликует второй раз, а после срока guid пост сначала ищется на стене
+            vk = conn.execute("UPDATE targets SET status = 'pending' WHERE status = 'sending' AND target = ?", (VK,)).rowcount
+            # У Telegram такой защиты нет: пост мог уйти - лучше не публиковать, чем опубликовать дважды
+            telegram = conn.execute(
+                "UPDATE targets SET status = 'failed', last_error = ? WHERE status = 'sending' AND target = ?",
+                (f"бот перезапустился во время отправки, {CHECK_CHANNEL}", TELEGRAM),
+            ).rowcount
+        if vk or telegram:
+            logger.warning(f"Outbox recovered interrupted publications: {vk} VK retried, {telegram} Telegram left for manual check")
+
+    def _retry_delay(self, attempts: int) -> float:
+        return min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay)
+
+    async def _publish_target(self, target: str, job: sqlite3.Row, photos: list[str]) -> bool:
+        if target == TELEGRAM:
+            media_group = [InputMediaPhoto(media=file_id) for file_id in photos]
+            return await publish_telegram_post(self._bot, job["text"], media_group)
+        return await self._publish_vk(job, photos)
+
+    async def _publish_vk(self, job: sqlite3.Row, photos: list[str]) -> bool:
+        conn = self._connect()
+        row = conn.execute("SELECT attempts, first_sent_at FROM targets WHERE job_id = ? AND target = ?", (job["id"], VK)).fetchone()
+        # guid защищает от двойного поста только в пределах срока, который VK его помнит:
+        # повтор позже сначала ищет пост прошлой попытки на стене
+        if row["attempts"] > 1 and time.time() - row["first_sent_at"] > self.vk_guid_window:
+            post_id = await find_wall_post(job["text"], row["first_sent_at"])
+            if post_id is not None:
+                logger.info(f"Outbox job {job['id']}: VK post {post_id} from an interrupted attempt found on the wall, not posting again")
+                self._save_post_id(job["id"], post_id)
+                return True
+
+        # Фото, загрузка которых не успела закончиться к постановке в очередь, ждем только для VK - Telegram они не задерживают
+        attachments = json.loads(job["vk_attachments"])
+        preuploaded = await photo_preuploader.wait(self.preupload_key(job["id"]))
+        if preuploaded:
+            attachments.update(preuploaded)
+            with conn:
+                conn.execute("UPDATE jobs SET vk_attachments = ? WHERE id = ?", (json.dumps(attachments), job["id"]))
+
+        # guid - ключ идемпотентности поста в VK
+        post_id = await publish_vk_post(self._bot, job["text"], photos, preuploaded=attachments, guid=job["idempotency_key"])
+        if post_id is None:
+            return False
+        self._save_post_id(job["id"], post_id)
+        return True
+
+    def _save_post_id(self, job_id: int, post_id: int):
+        with self._connect() as conn:
+            conn.execute("UPDATE targets SET post_id = ? WHERE job_id = ? AND target = ?", (post_id, job_id, VK))
+
+    async def _process_job(self, job: sqlite3.Row):
+        conn = self._connect()
+        now = time.time()
+        targets = [
+            row["target"] for row in conn.execute(
+                "SELECT target FROM targets WHERE job_id = ? AND status = 'pending' AND next_attempt_at <= ?", (job["id"], now)
+            )
+        ]
+        # Отмечаем отправку до публикации: после перезапуска будет видно, какие попытки прервались
+        with conn:
+            conn.executemany(
+                "UPDATE targets SET status = 'sending', attempts = attempts + 1, first_sent_at = COALESCE(first_sent_at, ?) "
+                "WHERE job_id = ? AND target = ?",
+                [(now, job["id"], target) for target in targets],
+            )
+
+        photos = json.loads(job["photos"])
+        results = await asyncio.gather(*(self._publish_target(target, job, photos) for target in targets), return_exceptions=True)
+        retry_in = None
+        with conn:
+            for target, result in zip(targets, results):
+                if result is True:
+                    conn.execute("UPDATE targets SET status = 'done', last_error = NULL WHERE job_id = ? AND target = ?", (job["id"], target))
+                    continue
+                if isinstance(result, DeliveryUnknown):
+                    # Как и при перезапуске: повтор мог бы опубликовать пост второй раз
+                    conn.execute(
+                        "UPDATE targets SET status = 'failed', last_error = ? WHERE job_id = ? AND target = ?",
+                        (f"нет ответа от Telegram ({result}), {CHECK_CHANNEL}", job["id"], target),
+                    )
+                    logger.warning(f"Outbox job {job['id']}: {target} delivery unknown, not retrying: {result}")
+                    continue
+                error = str(result) if isinstance(result, Exception) else UNKNOWN_ERROR
+                if isinstance(result, Exception):
+                    logger.error(f"Outbox job {job['id']}: {target} publication error: {result}", exc_info=result)
+                attempts = conn.execute(
+                    "SELECT attempts FROM targets WHERE job_id = ? AND target = ?", (job["id"], target)
+                ).fetchone()["attempts"]
+                if attempts >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE targets SET status = 'failed', last_error = ? WHERE job_id = ? AND target = ?", (error, job["id"], target)
+                    )
+                    continue
+                delay = self._retry_delay(attempts)
+                retry_in = delay if retry_in is None else min(retry_in, delay)
+                self.retries += 1
+                conn.execute(
+                    "UPDATE targets SET status = 'pending', last_error = ?, next_attempt_at = ? WHERE job_id = ? AND target = ?",
+                    (error, time.time() + delay, job["id"], target),
+                )
+                logger.warning(f"Outbox job {job['id']}: {target} failed (attempt {attempts}/{self.max_attempts}), retry in {delay:.0f}s")
+
+        if retry_in is not None:
+            await self._report(job, f"⚠️ Публикация не удалась с первого раза, повторю через {retry_in:.0f} с...")
+
+    async def _finish_job(self, job: sqlite3.Row):
+        """Закрывает задачу, в которой все площадки опубликованы или исчерпали попытки, и сообщает результат"""
+        conn = self._connect()
+        targets = {row["target"]: row for row in conn.execute("SELECT * FROM targets WHERE job_id = ?", (job["id"],))}
+        with conn:
+            conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), job["id"]))
+        published = [target for target, row in targets.items() if row["status"] == "done"]
+        failed = [target for target, row in targets.items() if row["status"] != "done"]
+
+        # Запоминаем опубликованный пост, чтобы не повторять его в будущих генерациях
+        if published:
+            duplicate_index.add(job["text"])
+            self.published += 1
+        if failed:
+            self.failed += 1
+
+        # Если VK не удался, отправляем уведомление в Telegram админу
+        if VK in failed:
+            try:
+                await self._bot.send_message(
+                    config.ADMIN_ID,
+                    f"⚠️ Ошибка публикации в VK:\n\n❌ ВНИМАНИЕ: Пост не опубликован в VK. Ошибка: {targets[VK]['last_error']}"
+                    + ("\n\nПост был опубликован только в Telegram канале." if TELEGRAM in published else "")
+                )
+            except Exception as notify_error:
+                logger.error(f"Не удалось отправить уведомление об ошибке VK админу: {notify_error}")
+        else:
+            logger.info(f"Outbox job {job['id']} finished: published to {published or 'nowhere'}")
+
+        if published and not failed:
+            result_message = f"✅ Пост успешно опубликован в {_target_names(published)}!"
+        elif published:
+            result_message = f"✅ Пост опубликован в {_target_names(published)}.\n⚠️ Не удалось опубликовать в {_target_names(failed)}."
+        elif len(failed) > 1:
+            result_message = f"❌ Не удалось опубликовать пост ни в {_target_names(failed, ', ни в ')}."
+        elif failed:
+            result_message = f"❌ Не удалось опубликовать пост в {_target_names(failed)}."
+        else:
+            result_message = "❌ Не настроена ни одна площадка для публикации (TELEGRAM_CHANNEL_ID, VK_USER_TOKEN)."
+        if TELEGRAM in failed and targets[TELEGRAM]["last_error"] != UNKNOWN_ERROR:
+            result_message += f"\nTelegram: {targets[TELEGRAM]['last_error']}"
+        await self._report(job, result_message)
+
+    async def _report(self, job: sqlite3.Row, text: str):
+        """Показывает статус публикации в сообщении, из которого ее запустили"""
+        if not job["chat_id"]:
+            return
+        try:
+            if job["message_id"]:
+                await self._bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["message_id"])
+                return
+        except Exception as e:
+            logger.debug(f"Could not edit publication status message: {e}")
+        try:
+            await self._bot.send_message(job["chat_id"], text)
+        except Exception as e:
+            logger.error(f"Could not send publication status: {e}")
+
+    async def _drain(self) -> float | None:
+        """Публикует все, что пора; возвращает, через сколько секунд будет следующая попытка (None - очередь пуста)"""
+        conn = self._connect()
+        due = conn.execute(
+            "SELECT * FROM jobs WHERE id IN (SELECT job_id FROM targets WHERE status = 'pending' AND next_attempt_at <= ?) ORDER BY id",
+            (time.time(),),
+        ).fetchall()
+        for job in due:
+            await self._process_job(job)
+        finished = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'pending' AND id NOT IN "
+            "(SELECT job_id FROM targets WHERE status IN ('pending', 'sending')) ORDER BY id"
+        ).fetchall()
+        for job in finished:
+            await self._finish_job(job)
+        next_at = conn.execute("SELECT MIN(next_attempt_at) FROM targets WHERE status = 'pending'").fetchone()[0]
+        return None if next_at is None else max(0.0, next_at - time.time())
+
+    async def _run(self):
+        self._recover()
+        logger.info(f"Outbox worker started ({self.count_pending()} pending posts)")
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self._drain()
+            except Exception as e:
+                logger.error(f"Ошибка при обработке очереди публикаций: {e}", exc_info=True)
+                delay = self.retry_delay
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot):
+        """Запускает фоновую публикацию из очереди"""
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую публикацию; недоставленные посты остаются в очереди до следующего запуска"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info(f"Outbox stopped. Stats: {self.get_stats()}")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": self.count_pending(),
+            "enqueued": self.enqueued,
+            "duplicates": self.duplicates,
+            "published": self.published,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
+
+
+outbox = Outbox()
+photo_preuploader.add_saver(PREUPLOAD_KIND, outbox.save_attachment)
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import time
+
+import config
+
+
+class PhotoCache:
+    """Соответствие фото из Telegram (file_unique_id) и уже сохраненных на стене VK вложений, с вытеснением давно не использованных"""
+
+    def __init__(self, path: str = config.PHOTO_CACHE_PATH, max_entries: int = config.PHOTO_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn: sqlite3.Connection | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS photos ("
+                "file_unique_id TEXT NOT NULL, group_id INTEGER NOT NULL, attachment TEXT NOT NULL, "
+                "last_used REAL NOT NULL, PRIMARY KEY (file_unique_id, group_id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS photos_last_used ON photos (last_used)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, file_unique_id: str, group_id: int) -> str | None:
+        """Возвращает вложение для фото, уже сохраненного на стене группы, или None"""
+        if not self.enabled:
+            return None
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT attachment FROM photos WHERE file_unique_id = ? AND group_id = ?", (file_unique_id, group_id)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        conn.execute(
+            "UPDATE photos SET last_used = ? WHERE file_unique_id = ? AND group_id = ?",
+            (time.time(), file_unique_id, group_id),
+        )
+        conn.commit()
+        return row[0]
+
+    def put(self, file_unique_id: str, group_id: int, attachment: str):
+        """Запоминает вложение и вытесняет самые давно использованные записи сверх max_entries"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO photos (file_unique_id, group_id, attachment, last_used) VALUES (?, ?, ?, ?)",
+            (file_unique_id, group_id, attachment, time.time()),
+        )
+        cursor = conn.execute(
+            "DELETE FROM photos WHERE rowid IN ("
+            "SELECT rowid FROM photos ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.evicted += cursor.rowcount
+        conn.commit()
+
+    def remove(self, file_unique_id: str, group_id: int):
+        """Удаляет запись (например, если фото удалили из VK)"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        conn.execute("DELETE FROM photos WHERE file_unique_id = ? AND group_id = ?", (file_unique_id, group_id))
+        conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        entries = self._connect().execute("SELECT COUNT(*) FROM photos").fetchone()[0] if self.enabled else 0
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 2) if total else None,
+            "evicted": self.evicted,
+        }
+
+
+photo_cache = PhotoCache()
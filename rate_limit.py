@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future, int]] = []  # (приоритет, номер в очереди, future, токенов)
+        self._counter = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+        self.acquired = 0
+        self.throttled = 0  # Сколько раз пришлось ждать токен
+        self.total_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _needed(self, tokens: int) -> float:
+        # Запрос дороже всего запаса ждет полного запаса, а остаток уходит в долг следующим запросам
+        return min(tokens, self.capacity)
+
+    async def acquire(self, priority: int = 0, tokens: int = 1):
+        """Ждет tokens свободных токенов; ожидающие обслуживаются по приоритету (меньше - раньше), при равном - по очереди"""
+        if self.rate <= 0:
+            return
+        self._refill()
+        if not self._waiters and self._tokens >= self._needed(tokens):
+            self._tokens -= tokens
+            self.acquired += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future, tokens))
+        self.throttled += 1
+        started = time.monotonic()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Токен успели выдать, но ждущего уже отменили - возвращаем токен
+            if future.done() and not future.cancelled():
+                self._tokens += tokens
+                self.acquired -= 1
+            raise
+        finally:
+            self.total_wait += time.monotonic() - started
+
+    async def _dispatch(self):
+        """Раздает токены ожидающим по мере пополнения; отмененные ожидания пропускаются"""
+        while self._waiters:
+            _, _, future, tokens = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            needed = self._needed(tokens)
+            if self._tokens < needed:
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+                continue
+            heapq.heappop(self._waiters)
+            self._tokens -= tokens
+            self.acquired += 1
+            future.set_result(None)
+
+    def pause(self, seconds: float):
+        """Не выдает токены ближайшие seconds секунд (например, по Retry-After от сервера)"""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def get_stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "total_wait_s": round(self.total_wait, 1),
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RetryDecision(NamedTuple):
+    """Результат классификации ошибки"""
+    retryable: bool  # Имеет ли смысл повторять запрос
+    counts_as_failure: bool = True  # Считать ли ошибку признаком недоступности сервиса (для предохранителя)
+    retry_after: float | None = None  # Сколько секунд просит подождать сервер (Retry-After)
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: сервис недавно был недоступен, запрос не отправляется"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name}: сервис временно недоступен, повтор через {retry_in:.0f} с")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии сбоев подряд отклоняет запросы сразу, пока сервис не восстановится"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self.rejected = 0
+        self.opened_count = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit breaker '{self.name}': {self._state} -> {state}")
+            self._state = state
+
+    def before_call(self):
+        """Проверяет, можно ли отправить запрос; при разомкнутом предохранителе бросает CircuitOpenError"""
+        state = self.state
+        if state == self.CLOSED:
+            return
+        # Пробный запрос мог быть отменен и не сообщить результат - не ждем его дольше reset_timeout
+        trial_stale = time.monotonic() - self._trial_started >= self.reset_timeout
+        if state == self.HALF_OPEN and (not self._trial_in_flight or trial_stale):
+            # Пропускаем один пробный запрос, остальные ждут его результата
+            self._set_state(self.HALF_OPEN)
+            self._trial_in_flight = True
+            self._trial_started = time.monotonic()
+            return
+        self.rejected += 1
+        retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(self.name, retry_in)
+
+    def record_success(self):
+        self._failures = 0
+        self._trial_in_flight = False
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self._state != self.OPEN:
+                self.opened_count += 1
+            self._set_state(self.OPEN)
+
+    def get_stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opened": self.opened_count,
+            "rejected": self.rejected,
+        }
+
+
+class RetryPolicy:
+    """Повторные попытки с экспоненциальной задержкой, случайным разбросом и учетом Retry-After"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 20.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float | None:
+        """Задержка перед попыткой номер attempt (с 1); None - ждать дольше max_delay нет смысла"""
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        # "Full jitter": равномерно от 0 до экспоненциальной границы, чтобы повторы не шли синхронно
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(
+        self,
+        func: Callable[[], Awaitable[T]],
+        classify: Callable[[BaseException], RetryDecision],
+        breaker: CircuitBreaker | None = None,
+        name: str = "request",
+    ) -> T:
+        """Выполняет func с повторами; неповторяемые ошибки и ошибку последней попытки пробрасывает наружу"""
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker:
+                breaker.before_call()
+            try:
+                result = await func()
+            except Exception as e:
+                decision = classify(e)
+                if breaker:
+                    # Осмысленный отказ (например, 400) означает, что сервис отвечает
+                    if decision.counts_as_failure:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not decision.retryable or attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt, decision.retry_after)
+                if delay is None:
+                    logger.warning(f"{name}: сервер просит подождать {decision.retry_after:.0f} с, не повторяем")
+                    raise
+                logger.warning(f"{name}: попытка {attempt}/{self.max_attempts} не удалась ({e}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            if breaker:
+                breaker.record_success()
+            return result
@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta, tzinfo
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import config
+from outbox import outbox
+from vk_preupload import photo_preuploader
+
+logger = logging.getLogger(__name__)
+
+PREUPLOAD_KIND = "schedule"  # Ключи фоновых загрузок фото отложенного поста: (PREUPLOAD_KIND, post_id)
+
+
+def get_timezone() -> tzinfo | None:
+    """Часовой пояс, в котором админ указывает время публикации (None - часовой пояс сервера)"""
+    try:
+        return ZoneInfo(config.TIMEZONE) if config.TIMEZONE else None
+    except ZoneInfoNotFoundError:
+        logger.warning(f"Unknown TIMEZONE '{config.TIMEZONE}', using server time")
+        return None
+
+
+def parse_schedule_time(text: str, now: datetime) -> datetime | None:
+    """Разбирает время публикации: "ЧЧ:ММ" (ближайшее), "ДД.ММ ЧЧ:ММ" или "ДД.ММ.ГГГГ ЧЧ:ММ"; None - если формат не подошел"""
+    match = re.fullmatch(r"(?:(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?\s+)?(\d{1,2})[:.](\d{2})", text.strip())
+    if not match:
+        return None
+    day, month, year, hour, minute = match.groups()
+    try:
+        if day is None:
+            run_at = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+            # Время уже прошло сегодня - значит, имеется в виду завтра
+            return run_at if run_at > now else run_at + timedelta(days=1)
+        run_at = now.replace(
+            year=int(year) if year else now.year, month=int(month), day=int(day),
+            hour=int(hour), minute=int(minute), second=0, microsecond=0,
+        )
+    except ValueError:
+        return None
+    # Дата без года, уже прошедшая в этом году, - следующий год
+    if year is None and run_at <= now:
+        run_at = run_at.replace(year=run_at.year + 1)
+    return run_at
+
+
+class PostScheduler:
+    """Отложенные публикации: очередь в SQLite и куча по времени в памяти, один таймер на все посты.
+
+    В нужное время пост ставится в outbox - дальше он публикуется так же, как по кнопке "Опубликовать".
+    """
+
+    def __init__(self, path: str = config.SCHEDULE_DB_PATH):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._heap: list[tuple[float, int]] = []
+        self._run_at: dict[int, float] = {}  # Актуальные записи кучи; отмененные удаляются отсюда и пропускаются
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.total_lag = 0.0  # Суммарное опоздание срабатываний (с) - для оценки точности таймера
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scheduled ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "idempotency_key TEXT NOT NULL, "
+                "run_at REAL NOT NULL, "
+                "chat_id INTEGER, "
+                "message_id INTEGER, "
+                "text TEXT NOT NULL, "
+                "photos TEXT NOT NULL, "
+                "vk_attachments TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'scheduled', "
+                "created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS scheduled_status ON scheduled (status, run_at)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def preupload_key(post_id: int) -> tuple:
+        """Ключ, под которым отложенный пост держит фоновые загрузки фото в VK до публикации"""
+        return (PREUPLOAD_KIND, post_id)
+
+    def _push(self, post_id: int, run_at: float):
+        self._run_at[post_id] = run_at
+        heapq.heappush(self._heap, (run_at, post_id))
+        # Будим таймер, только если новый пост раньше того, которого он ждет
+        if self._heap[0][1] == post_id:
+            self._wakeup.set()
+
+    def add(
+        self,
+        run_at: float,
+        key: str,
+        text: str,
+        photos: list[str],
+        vk_attachments: dict[str, str] | None = None,
+        chat_id: int | None = None,
+        message_id: int | None = None,
+    ) -> int:
+        """Планирует публикацию на run_at (unix-время); возвращает id отложенного поста"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO scheduled (idempotency_key, run_at, chat_id, message_id, text, photos, vk_attachments, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, run_at, chat_id, message_id, text, json.dumps(photos), json.dumps(vk_attachments or {}), time.time()),
+            )
+        post_id = cursor.lastrowid
+        self.scheduled += 1
+        self._push(post_id, run_at)
+        return post_id
+
+    async def cancel(self, post_id: int) -> bool:
+        """Отменяет еще не опубликованный пост; фото, загруженные в VK только для него, удаляются"""
+        conn = self._connect()
+        with conn:
+            cancelled = conn.execute(
+                "UPDATE scheduled SET status = 'cancelled' WHERE id = ? AND status = 'scheduled'", (post_id,)
+            ).rowcount
+        if not cancelled:
+            return False
+        self._run_at.pop(post_id, None)
+        self.cancelled += 1
+        await photo_preuploader.discard(self.preupload_key(post_id))
+        return True
+
+    def save_attachment(self, post_id: int, file_id: str, attachment: str):
+        """Дописывает в отложенный пост вложение фото, догруженного в VK после планирования"""
+        conn = self._connect()
+        row = conn.execute("SELECT vk_attachments FROM scheduled WHERE id = ? AND status = 'scheduled'", (post_id,)).fetchone()
+        if row is None:
+            return
+        attachments = {**json.loads(row["vk_attachments"]), file_id: attachment}
+        with conn:
+            conn.execute("UPDATE scheduled SET vk_attachments = ? WHERE id = ?", (json.dumps(attachments), post_id))
+
+    def list_scheduled(self) -> list[sqlite3.Row]:
+        return self._connect().execute("SELECT * FROM scheduled WHERE status = 'scheduled' ORDER BY run_at").fetchall()
+
+    def count_scheduled(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM scheduled WHERE status = 'scheduled'").fetchone()[0]
+
+    def _load(self):
+        """Восстанавливает кучу из базы: посты, время которых прошло, пока бот был выключен, публикуются сразу"""
+        self._heap = [(row["run_at"], row["id"]) for row in self.list_scheduled()]
+        heapq.heapify(self._heap)
+        self._run_at = {post_id: run_at for run_at, post_id in self._heap}
+
+    async def _fire(self, post_id: int):
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM scheduled WHERE id = ? AND status = 'scheduled'", (post_id,)).fetchone()
+        if row is None:
+            return
+        self.fired += 1
+        self.total_lag += max(0.0, time.time() - row["run_at"])
+        # Тот же ключ идемпотентности: если бот упадет до отметки ниже, повторная постановка в outbox ничего не добавит
+        job_id, _ = outbox.enqueue(
+            row["idempotency_key"], row["text"], json.loads(row["photos"]), json.loads(row["vk_attachments"]),
+            chat_id=row["chat_id"], message_id=row["message_id"],
+        )
+        # Недогруженные фото не держат таймер: их дождется outbox перед публикацией в VK
+        photo_preuploader.hand_over(self.preupload_key(post_id), outbox.preupload_key(job_id))
+        with conn:
+            conn.execute("UPDATE scheduled SET status = 'queued' WHERE id = ?", (post_id,))
+        logger.info(f"Scheduled post {post_id} queued for publication")
+
+    async def _run(self):
+        self._load()
+        logger.info(f"Post scheduler started ({len(self._heap)} scheduled posts)")
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][0] <= time.time():
+                run_at, post_id = heapq.heappop(self._heap)
+                # Отмененные и перенесенные посты остаются в куче - пропускаем их
+                if self._run_at.get(post_id) != run_at:
+                    continue
+                del self._run_at[post_id]
+                try:
+                    await self._fire(post_id)
+                except Exception as e:
+                    logger.error(f"Failed to queue scheduled post {post_id}: {e}", exc_info=True)
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Запускает таймер отложенных публикаций"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info(f"Post scheduler stopped. Stats: {self.get_stats()}")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_stats(self) -> dict:
+        return {
+            "scheduled": self.count_scheduled(),
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "avg_lag_ms": round(self.total_lag / self.fired * 1000) if self.fired else None,
+        }
+
+
+post_scheduler = PostScheduler()
+photo_preuploader.add_saver(PREUPLOAD_KIND, post_scheduler.save_attachment)
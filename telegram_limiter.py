@@ -0,0 +1,107 @@
+import logging
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, SendMediaGroup, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+import config
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Меньше - раньше: публикации в канал не ждут за обновлениями черновиков и кнопок
+PRIORITY_PUBLISH = 0
+PRIORITY_UI = 1
+
+# Короткие всплески Telegram допускает - несколько сообщений подряд в чат уходят без ожидания
+CHAT_BURST = 3
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Ограничитель исходящих запросов бота: общий лимит и лимит на каждый чат, повтор после RetryAfter.
+
+    Подключается к сессии бота, поэтому покрывает все вызовы: публикации, ответы и редактирование сообщений.
+    Ограничиваются только методы с chat_id (отправка, редактирование, удаление); остальные идут без ожидания.
+    """
+
+    def __init__(
+        self,
+        rate: float = config.TELEGRAM_RATE_LIMIT,
+        chat_rate: float = config.TELEGRAM_CHAT_RATE_LIMIT,
+        group_rate_per_minute: float = config.TELEGRAM_GROUP_RATE_LIMIT,
+        retry_attempts: int = config.TELEGRAM_RETRY_ATTEMPTS,
+        max_retry_after: int = config.TELEGRAM_MAX_RETRY_AFTER,
+    ):
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.retry_attempts = retry_attempts
+        self.max_retry_after = max_retry_after
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self.flood_errors = 0
+        self.retries = 0
+
+    @staticmethod
+    def _chat_key(chat_id: int | str) -> int | str:
+        """Один чат - один ключ: числовой id строкой ("-100...") и числом попадает в одну корзину"""
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            return int(chat_id)
+        return chat_id
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Положительный id - личный чат; отрицательный или @username - группа или канал, у них лимит строже
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.chat_rate if private else self.group_rate, capacity=CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        chat_id = self._chat_key(chat_id)
+        priority = PRIORITY_PUBLISH if chat_id == self._chat_key(config.TELEGRAM_CHANNEL_ID) else PRIORITY_UI
+        chat_bucket = self._chat_bucket(chat_id)
+        # Альбом Telegram считает по сообщению на каждое фото
+        tokens = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        attempt = 0
+        while True:
+            await chat_bucket.acquire(priority, tokens)
+            await self.bucket.acquire(priority, tokens)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_errors += 1
+                if attempt >= self.retry_attempts or e.retry_after > self.max_retry_after:
+                    raise
+                attempt += 1
+                self.retries += 1
+                # Пауза на весь чат: следующие сообщения в него тоже подождут, а не получат ту же ошибку
+                chat_bucket.pause(e.retry_after)
+                logger.warning(
+                    f"Telegram flood control on {type(method).__name__} in chat {chat_id}: "
+                    f"retry {attempt}/{self.retry_attempts} in {e.retry_after}s"
+                )
+
+    def get_stats(self) -> dict:
+        throttled = self.bucket.throttled + sum(bucket.throttled for bucket in self._chat_buckets.values())
+        total_wait = self.bucket.total_wait + sum(bucket.total_wait for bucket in self._chat_buckets.values())
+        return {
+            "requests": self.bucket.acquired,
+            "throttled": throttled,
+            "total_wait_s": round(total_wait, 1),
+            "flood_errors": self.flood_errors,
+            "retries": self.retries,
+        }
+
+
+telegram_limiter = TelegramRateLimiter()
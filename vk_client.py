@@ -0,0 +1,236 @@
+import importlib.util
+import json
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable
+
+import httpx
+
+import config
+from llm_client import LatencyTracker
+from rate_limit import TokenBucket
+from retry import RetryDecision, RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.vk.com/method/"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+TOO_MANY_REQUESTS = 6  # Код ошибки VK "Too many requests per second"
+MAX_EXECUTE_CALLS = 25  # Сколько вызовов API VK разрешает в одном execute
+AUTH_ERRORS = {5, 27, 214}  # Токен недействителен, токен группы вместо токена пользователя, нет прав на публикацию
+
+
+class VKAPIError(Exception):
+    """Ошибка, которую вернул VK API (поле error в ответе)"""
+
+    def __init__(self, method: str, code: int, message: str):
+        super().__init__(f"{method}: VK API error {code} - {message}")
+        self.method = method
+        self.code = code
+        self.message = message
+
+
+def classify_vk_error(error: BaseException) -> RetryDecision:
+    """Повторяем только ошибку 6: запрос не выполнен, и после паузы его можно безопасно отправить снова"""
+    if isinstance(error, VKAPIError) and error.code == TOO_MANY_REQUESTS:
+        return RetryDecision(retryable=True, counts_as_failure=False)
+    return RetryDecision(retryable=False)
+
+
+class VKClient:
+    """Долгоживущий клиент VK API: пул соединений, версия API, токен, разбор ошибок и задержки по методам"""
+
+    def __init__(
+        self,
+        token: str = config.VK_USER_TOKEN,
+        version: str = config.VK_API_VERSION,
+        http2: bool = config.VK_HTTP2,
+        pool_limit: int = config.VK_POOL_LIMIT,
+        request_timeout: float = config.VK_REQUEST_TIMEOUT,
+        upload_timeout: float = config.VK_UPLOAD_TIMEOUT,
+        rate_limit: float = config.VK_RATE_LIMIT,
+        retry_attempts: int = config.VK_RETRY_ATTEMPTS,
+    ):
+        self.token = token
+        self.version = version
+        # HTTP/2 требует пакет h2; без него работаем по HTTP/1.1 с keep-alive
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.pool_limit = pool_limit
+        self.request_timeout = request_timeout
+        self.upload_timeout = upload_timeout
+        self._client: httpx.AsyncClient | None = None
+        # Запас в один токен: запросы идут равномерно и не превышают лимит VK в пределах любой секунды
+        self.rate_limiter = TokenBucket(rate_limit, capacity=1)
+        self.retry_policy = RetryPolicy(max_attempts=retry_attempts, base_delay=1.0, max_delay=5.0)
+        self._auth_error_listeners: list[Callable[[], None]] = []
+        self.batched_calls = 0  # Вызовов API, выполненных внутри execute
+        self._latency: dict[str, LatencyTracker] = {}
+        self._calls: dict[str, int] = {}
+        self._errors: dict[str, int] = {}
+
+    def add_auth_error_listener(self, callback: Callable[[], None]):
+        """Регистрирует функцию, которая вызывается при ошибках авторизации (например, для сброса кэшей)"""
+        self._auth_error_listeners.append(callback)
+
+    async def start(self):
+        """Создает пул соединений заранее"""
+        self._get_client()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info(f"VK client closed. Stats: {self.get_stats()}")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=httpx.Timeout(timeout=self.request_timeout),
+                limits=httpx.Limits(max_connections=self.pool_limit, max_keepalive_connections=self.pool_limit),
+                headers={"User-Agent": USER_AGENT},
+            )
+            logger.info(f"VK client started (HTTP/{'2' if self.http2 else '1.1'}, API {self.version})")
+        return self._client
+
+    def _record(self, name: str, started: float, failed: bool):
+        self._latency.setdefault(name, LatencyTracker()).record((time.perf_counter() - started) * 1000)
+        self._calls[name] = self._calls.get(name, 0) + 1
+        if failed:
+            self._errors[name] = self._errors.get(name, 0) + 1
+
+    @staticmethod
+    def _decode(name: str, response: httpx.Response) -> Any:
+        try:
+            return response.json()
+        except ValueError:
+            raise VKAPIError(name, -1, f"invalid JSON response: {response.text[:200]}")
+
+    async def call(self, method: str, **params) -> Any:
+        """Вызывает метод API и возвращает поле response; ошибку API бросает как VKAPIError"""
+        result = await self._call(method, params)
+        return result.get("response")
+
+    async def _call(self, method: str, params: dict) -> dict:
+        params.setdefault("access_token", self.token)
+        params.setdefault("v", self.version)
+        return await self.retry_policy.run(lambda: self._call_once(method, params), classify_vk_error, name=f"VK {method}")
+
+    async def _call_once(self, method: str, params: dict) -> dict:
+        await self.rate_limiter.acquire()
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await self._get_client().post(API_URL + method, data=params)
+            result = self._decode(method, response)
+            if "error" in result:
+                error = result["error"]
+                raise self._api_error(method, error.get("error_code", 0), error.get("error_msg", "Unknown error"))
+            failed = False
+            return result
+        finally:
+            self._record(method, started, failed)
+
+    def _api_error(self, method: str, code: int, message: str) -> VKAPIError:
+        if code in AUTH_ERRORS:
+            for callback in self._auth_error_listeners:
+                callback()
+        return VKAPIError(method, code, message)
+
+    async def execute(self, code: str, calls: int, **args) -> list[Any]:
+        """Выполняет VKScript, возвращающий массив результатов вызовов API.
+
+        Вызов, завершившийся ошибкой, VK возвращает как false, а описание кладет в execute_errors
+        в порядке выполнения; на его месте в результате оказывается VKAPIError.
+        """
+        result = await self._call("execute", {"code": code, **args})
+        self.batched_calls += calls
+        errors = iter(result.get("execute_errors", []))
+        items = []
+        for item in result.get("response") or []:
+            if item is False:
+                error = next(errors, {})
+                item = self._api_error(error.get("method", "execute"), error.get("error_code", 0), error.get("error_msg", "Unknown error"))
+            items.append(item)
+        return items
+
+    async def execute_calls(self, calls: list[tuple[str, dict]]) -> list[Any]:
+        """Выполняет независимые вызовы API пачками по MAX_EXECUTE_CALLS через execute; ошибки - VKAPIError на месте результата"""
+        if len(calls) == 1:
+            method, params = calls[0]
+            try:
+                return [await self.call(method, **params)]
+            except VKAPIError as e:
+                return [e]
+        results = []
+        for start in range(0, len(calls), MAX_EXECUTE_CALLS):
+            chunk = calls[start:start + MAX_EXECUTE_CALLS]
+            code = "return [" + ", ".join(
+                f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params in chunk
+            ) + "];"
+            results.extend(await self.execute(code, len(chunk)))
+        return results
+
+    async def upload(self, upload_url: str, files: dict) -> dict:
+        """Отправляет файлы на сервер загрузки VK и возвращает его ответ"""
+        return await self._upload(upload_url, files=files)
+
+    async def upload_stream(
+        self,
+        upload_url: str,
+        field: str,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        size: int | None = None,
+        content_type: str = "image/jpeg",
+    ) -> dict:
+        """Отправляет файл на сервер загрузки VK потоком: multipart-тело собирается из чанков по мере их поступления"""
+        boundary = uuid.uuid4().hex
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+
+        async def body():
+            yield head
+            async for chunk in chunks:
+                yield chunk
+            yield tail
+
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        # С известным размером отправляем обычный запрос с Content-Length, а не chunked
+        if size is not None:
+            headers["Content-Length"] = str(len(head) + size + len(tail))
+        return await self._upload(upload_url, content=body(), headers=headers)
+
+    async def _upload(self, upload_url: str, **kwargs) -> dict:
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await self._get_client().post(upload_url, timeout=httpx.Timeout(timeout=self.upload_timeout), **kwargs)
+            result = self._decode("upload", response)
+            if "error" in result:
+                raise VKAPIError("upload", 0, str(result["error"]))
+            failed = False
+            return result
+        finally:
+            self._record("upload", started, failed)
+
+    def get_stats(self) -> dict:
+        """Число вызовов, ошибок и задержки (p50/p90, мс) по каждому методу"""
+        stats = {}
+        for name, tracker in self._latency.items():
+            p50, p90 = tracker.percentile(50), tracker.percentile(90)
+            stats[name] = {
+                "calls": self._calls.get(name, 0),
+                "errors": self._errors.get(name, 0),
+                "p50_ms": round(p50) if p50 is not None else None,
+                "p90_ms": round(p90) if p90 is not None else None,
+            }
+        return stats
+
+
+vk_client = VKClient()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+import config
+from photo_cache import photo_cache
+from vk_publisher import delete_wall_photos, resolve_group_id, save_wall_photo
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoPreuploader:
+    """Загрузка фото в VK в фоне сразу после получения, чтобы при публикации оставался только wall.post"""
+
+    def __init__(self):
+        # chat_id (или ключ публикации) -> {file_id: задача, возвращающая (вложение, загружено ли фото сейчас)}
+        self._tasks: dict[Hashable, dict[str, asyncio.Task]] = {}
+        self._unique_ids: dict[str, str] = {}  # file_id -> file_unique_id для очистки кэша фото
+        # Задача -> ключ, под которым она сейчас числится: результат сохраняется туда, куда фото передано
+        self._keys: dict[asyncio.Task, Hashable] = {}
+        # Вид ключа (первый элемент кортежа, например "outbox") -> сохранение вложения в запись этого ключа
+        self._savers: dict[str, Callable[[int, str, str], None]] = {}
+        self.started = 0
+        self.uploaded = 0
+        self.used = 0  # Фото, которые при публикации взяли уже загруженными
+        self.cancelled = 0
+        self.deleted = 0
+
+    def add_saver(self, kind: str, saver: Callable[[int, str, str], None]):
+        """Регистрирует сохранение результатов для ключей вида (kind, id): saver(id, file_id, вложение)"""
+        self._savers[kind] = saver
+
+    def start(self, chat_id: int, bot: Bot, photo: PhotoSize, on_saved: Callable[[str, str], Awaitable[None]] | None = None):
+        """Запускает фоновую загрузку фото (get_file тоже в фоне).
+
+        on_saved(file_id, вложение) вызывается после сохранения на стене, если фото все еще числится за чатом;
+        если его уже передали публикации (hand_over), вложение записывается в ее запись через saver.
+        """
+        if not config.VK_USER_TOKEN:
+            return
+        tasks = self._tasks.setdefault(chat_id, {})
+        if photo.file_id in tasks:
+            return
+        self._unique_ids[photo.file_id] = photo.file_unique_id
+        task = asyncio.create_task(self._preupload(bot, photo, on_saved))
+        tasks[photo.file_id] = task
+        self._keys[task] = chat_id
+        self.started += 1
+
+    async def _preupload(self, bot: Bot, photo: PhotoSize, on_saved) -> tuple[str | None, bool]:
+        try:
+            group_id = await resolve_group_id()
+            if not group_id:
+                return None, False
+            file_info = await bot.get_file(photo.file_id)
+            attachment, fresh = await save_wall_photo(bot, file_info, abs(int(group_id)))
+        except Exception as e:
+            logger.error(f"Failed to pre-upload photo to VK: {e}")
+            return None, False
+        if attachment:
+            if fresh:
+                self.uploaded += 1
+            await self._save(self._keys.get(asyncio.current_task()), photo.file_id, attachment, on_saved)
+        return attachment, fresh
+
+    async def _save(self, key: Hashable | None, file_id: str, attachment: str, on_saved):
+        if key is None:
+            # Пост, для которого грузилось фото, уже сброшен - записывать некуда
+            return
+        if isinstance(key, tuple):
+            saver = self._savers.get(key[0])
+            if saver is not None:
+                saver(key[1], file_id, attachment)
+        elif on_saved is not None:
+            await on_saved(file_id, attachment)
+
+    def hand_over(self, chat_id: int, key: Hashable):
+        """Передает загрузки чата под другой ключ (например, задачи публикации), не отменяя их: чат освобождается для нового поста"""
+        tasks = self._tasks.pop(chat_id, None)
+        if tasks:
+            self._tasks[key] = tasks
+            for task in tasks.values():
+                self._keys[task] = key
+
+    async def wait(self, key: Hashable) -> dict[str, str]:
+        """Дожидается загрузок для чата (или ключа) и забывает их (фото переходят в публикацию); возвращает file_id -> вложение"""
+        tasks = self._tasks.pop(key, {})
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for task in tasks.values():
+            self._keys.pop(task, None)
+        attachments = {}
+        for file_id, result in zip(tasks, results):
+            self._unique_ids.pop(file_id, None)
+            if isinstance(result, tuple) and result[0]:
+                attachments[file_id] = result[0]
+        self.used += len(attachments)
+        return attachments
+
+    async def discard(self, key: Hashable):
+        """Отменяет незавершенные загрузки для чата (или ключа) и удаляет из VK фото, загруженные ради брошенного поста"""
+        tasks = self._tasks.pop(key, {})
+        if not tasks:
+            return
+        for task in tasks.values():
+            self._keys.pop(task, None)
+        pending = [task for task in tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        self.cancelled += len(pending)
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        # Фото из кэша могли войти в уже опубликованные посты - удаляем только загруженные для этого поста
+        fresh = {}
+        for file_id, task in tasks.items():
+            file_unique_id = self._unique_ids.pop(file_id, None)
+            if task.cancelled() or task.exception() is not None:
+                continue
+            attachment, uploaded = task.result()
+            if attachment and uploaded:
+                fresh[file_unique_id] = attachment
+        if not fresh:
+            return
+        group_id = await resolve_group_id()
+        for file_unique_id in fresh:
+            if group_id and file_unique_id:
+                photo_cache.remove(file_unique_id, abs(int(group_id)))
+        deleted = await delete_wall_photos(list(fresh.values()))
+        self.deleted += deleted
+        logger.info(f"Discarded pre-uploaded photos: {len(pending)} cancelled, {deleted} deleted from VK")
+
+    def get_stats(self) -> dict:
+        return {
+            "started": self.started,
+            "uploaded": self.uploaded,
+            "used": self.used,
+            "cancelled": self.cancelled,
+            "deleted": self.deleted,
+        }
+
+
+photo_preuploader = PhotoPreuploader()
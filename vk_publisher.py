@@ -1,218 +1,235 @@
 import asyncio
-import logging
-import httpx
 import json
+import logging
 import os
+from typing import AsyncIterator
 from aiogram import Bot
+from aiogram.types import File
 from dotenv import load_dotenv
 load_dotenv()
 import config
+from async_cache import AsyncTTLCache
+from image_processing import image_processor
+from photo_cache import photo_cache
+from vk_client import VKAPIError, vk_client
 
 logger = logging.getLogger(__name__)
 
-async def upload_photo_to_vk_wall(bot: Bot, file_id: str):
-    """Загрузка фото на стену группы ВКонтакте"""
+INVALID_PARAMETER = 100  # Код ошибки VK "One of the parameters specified was missing or invalid"
+WALL_CHECK_POSTS = 50  # Сколько последних постов стены просматривать в поисках прерванной публикации
+
+# Права токена и ID группы почти не меняются - не запрашиваем их при каждой публикации.
+# Кэшируются только успешные результаты; ошибка авторизации VK сбрасывает кэш
+vk_lookup_cache = AsyncTTLCache(config.VK_LOOKUP_CACHE_TTL, name="vk_lookup")
+vk_client.add_auth_error_listener(vk_lookup_cache.clear)
+
+# Адрес сервера загрузки фото действует долго - получаем его один раз на группу и используем для всех фото
+upload_server_cache = AsyncTTLCache(config.VK_UPLOAD_SERVER_TTL, name="vk_upload_server")
+vk_client.add_auth_error_listener(upload_server_cache.clear)
+
+def log_vk_error(action: str, error: VKAPIError):
+    """Пишет в лог ошибку VK API с подсказками для частых проблем с правами токена"""
+    # Специальная обработка ошибки 214 (Access to adding post denied)
+    if error.code == 214:
+        logger.error(f"VK API error 214 {action}: Access to adding post denied. "
+                   f"Это означает, что у токена нет прав на публикацию от имени группы или на стене запрещены публикации для данного пользователя. "
+                   f"Причины ошибки и способы устранения:\n"
+                   f"1. ❌ Неправильный токен: Убедитесь, что используете токен пользователя-администратора группы, а не токен самой группы\n"
+                   f"2. ⚙️ Настройки группы: Перейдите в настройки группы → 'Управление сообществом' и убедитесь, что разрешена публикация от имени сообщества\n"
+                   f"3. 👤 Права токена: Токен должен быть получен от пользователя с правами администратора группы\n"
+                   f"4. 🌐 Параметры API: Убедитесь, что передаете правильные параметры, включая owner_id группы с префиксом '-' (например, -ID группы)\n"
+                   f"5. ⏳ Лимиты публикаций: Если ошибка связана с лимитом публикаций, подождите некоторое время перед повторной попыткой\n\n"
+                   f"✅ Решение: Используйте токен ПОЛЬЗОВАТЕЛЯ с правами администратора группы, а не токен самой группы. "
+                   f"Только токен пользователя с правами администратора группы может публиковать посты от имени группы. "
+                   f"Error details: {error.message}")
+    elif error.code == 27:  # Group authorization failed
+        logger.error(f"VK API error 27: Group authorization failed. "
+                   f"Это означает, что используется токен группы вместо токена пользователя-администратора. "
+                   f"Error details: {error.message}")
+    else:
+        logger.error(f"VK API error {action}: {error.code} - {error.message}")
+
+def _has_upload_url(upload_server) -> bool:
+    return bool(upload_server) and 'upload_url' in upload_server
+
+async def _get_upload_url(group_id: int) -> str | None:
+    """Адрес для загрузки фото на стену группы (из кэша или новый)"""
     try:
-        # Получаем информацию о файле из Telegram
-        file_info = await bot.get_file(file_id)
-        file_url = f"https://api.telegram.org/file/bot{config.TELEGRAM_TOKEN}/{file_info.file_path}"
-        
-        # Получаем URL для загрузки фото на стену группы
-        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=10.0)) as client:
-            # Используем метод для стены группы - передаем group_id как параметр
-            response = await client.get(
-                "https://api.vk.com/method/photos.getWallUploadServer",
-                params={
-                    'group_id': abs(int(config.VK_GROUP_ID)),
-                    'access_token': config.VK_USER_TOKEN,
-                    'v': '5.131'
-                }
-            )
-            
-            try:
-                upload_data = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON response from VK API: {response.text}")
-                return None
-            
-            # Проверяем на ошибки
-            if 'error' in upload_data:
-                error = upload_data['error']
-                error_code = error.get('error_code', 'Unknown')
-                error_msg = error.get('error_msg', 'Unknown error')
-                
-                # Специальная обработка ошибки 214 (Access to adding post denied)
-                if error_code == 214:
-                    logger.error(f"VK API error 214 getting wall upload server: Access to adding post denied. "
-                               f"Это означает, что у токена нет прав на публикацию от имени группы или на стене запрещены публикации для данного пользователя. "
-                               f"Причины ошибки и способы устранения:\n"
-                               f"1. ❌ Неправильный токен: Убедитесь, что используете токен пользователя-администратора группы, а не токен самой группы\n"
-                               f"2. ⚙️ Настройки группы: Перейдите в настройки группы → 'Управление сообществом' и убедитесь, что разрешена публикация от имени сообщества\n"
-                               f"3. 👤 Права токена: Токен должен быть получен от пользователя с правами администратора группы\n"
-                               f"4. 🌐 Параметры API: Убедитесь, что передаете правильные параметры, включая owner_id группы с префиксом '-' (например, -ID группы)\n"
-                               f"5. ⏳ Лимиты публикаций: Если ошибка связана с лимитом публикаций, подождите некоторое время перед повторной попыткой\n\n"
-                               f"✅ Решение: Используйте токен ПОЛЬЗОВАТЕЛЯ с правами администратора группы, а не токен самой группы. "
-                               f"Только токен пользователя с правами администратора группы может публиковать посты от имени группы. "
-                               f"Error details: {error_msg}")
-                else:
-                    logger.error(f"VK API error getting wall upload server: {error_code} - {error_msg}")
-                return None
-            
-            if 'response' not in upload_data or 'upload_url' not in upload_data['response']:
-                logger.error(f"Missing upload_url in response: {upload_data}")
-                return None
-            
-            upload_url = upload_data['response']['upload_url']
-            
-            # Загружаем фото с Telegram
-            try:
-                file_response = await client.get(file_url, timeout=httpx.Timeout(timeout=30.0), headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"})
-                files = {'photo': ('photo.jpg', file_response.content)}
-                upload_response = await client.post(upload_url, files=files, timeout=httpx.Timeout(timeout=30.0), headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"})
-            except httpx.TimeoutException:
-                logger.error("Timeout during photo upload to VK")
-                return None
-            except httpx.RequestError as e:
-                logger.error(f"Request error during photo upload to VK: {e}")
-                return None
-            
-            try:
-                photo_data = upload_response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON response from VK upload: {upload_response.text}")
-                return None
-            
-            # Проверяем, что все необходимые параметры присутствуют
-            if 'photo' not in photo_data or 'server' not in photo_data or 'hash' not in photo_data:
-                logger.error(f"Missing required fields in photo upload response: {photo_data}")
+        upload_server = await upload_server_cache.get_or_load(
+            group_id,
+            lambda: vk_client.call("photos.getWallUploadServer", group_id=group_id),
+            cache_if=_has_upload_url,
+        )
+    except VKAPIError as e:
+        log_vk_error("getting wall upload server", e)
+        return None
+    if not _has_upload_url(upload_server):
+        logger.error(f"Missing upload_url in response: {upload_server}")
+        return None
+    return upload_server['upload_url']
+
+async def _buffered(chunks: AsyncIterator[bytes], max_chunks: int) -> AsyncIterator[bytes]:
+    """Читает источник в фоне через очередь не больше max_chunks чанков: скачивание и отправка идут одновременно, а память ограничена"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_chunks))
+    done = object()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+async def _send_photo(bot: Bot, file_info: File, upload_url: str) -> dict:
+    """Передает фото из Telegram на сервер загрузки VK: потоком или, если включена обработка, после уменьшения"""
+    if image_processor.should_process(file_info.file_size):
+        # Для уменьшения фото нужен весь файл; одновременно в памяти не больше фото, чем процессов обработки
+        async with image_processor.slots:
+            photo_bytes = (await bot.download_file(file_info.file_path)).getvalue()
+            photo_bytes = await image_processor.process(photo_bytes)
+        return await vk_client.upload(upload_url, files={'photo': ('photo.jpg', photo_bytes)})
+    if bot.session.api.is_local:
+        # Локальный сервер Bot API отдает файлы с диска - читаем их целиком, как раньше
+        photo_bytes = (await bot.download_file(file_info.file_path)).getvalue()
+        return await vk_client.upload(upload_url, files={'photo': ('photo.jpg', photo_bytes)})
+    chunks = bot.session.stream_content(
+        url=bot.session.api.file_url(bot.token, file_info.file_path),
+        timeout=config.VK_UPLOAD_TIMEOUT,
+        chunk_size=config.PHOTO_TRANSFER_CHUNK_KB * 1024,
+        raise_for_status=True,
+    )
+    return await vk_client.upload_stream(
+        upload_url, 'photo', 'photo.jpg',
+        _buffered(chunks, config.PHOTO_TRANSFER_BUFFER_CHUNKS),
+        size=file_info.file_size,
+    )
+
+async def _upload_photo_file(bot: Bot, file_info: File, group_id: int) -> dict | None:
+    """Загружает фото из Telegram на сервер VK; возвращает параметры для photos.saveWallPhoto"""
+    try:
+        # Если сервер загрузки отверг фото, адрес мог устареть - пробуем еще раз с новым
+        for attempt in range(2):
+            upload_url = await _get_upload_url(group_id)
+            if not upload_url:
                 return None
-            
-            # Сохраняем фото на стене группы - добавляем group_id в параметры
             try:
-                save_response = await client.post(
-                    "https://api.vk.com/method/photos.saveWallPhoto",
-                    data={
-                        'group_id': abs(int(config.VK_GROUP_ID)),
-                        'photo': photo_data['photo'],
-                        'server': photo_data['server'],
-                        'hash': photo_data['hash'],
-                        'access_token': config.VK_USER_TOKEN,
-                        'v': '5.131'
-                    }
-                )
-                
-                try:
-                    saved_data = save_response.json()
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to decode JSON response from VK save: {save_response.text}")
-                    return None
-            except httpx.TimeoutException:
-                logger.error("Timeout during photo save to VK")
-                return None
-            except httpx.RequestError as e:
-                logger.error(f"Request error during photo save to VK: {e}")
-                return None
-            
-            # Проверяем на ошибки
-            if 'error' in saved_data:
-                logger.error(f"VK API error saving wall photo: {saved_data['error']}")
-                return None
-            
-            # Возвращаем идентификатор фото в формате "photo{owner_id}_{id}"
-            photo = saved_data['response'][0]
-            owner_id = photo['owner_id']
-            media_id = photo['id']
-            
-            return f"photo{int(owner_id)}_{int(media_id)}"
-            
+                photo_data = await _send_photo(bot, file_info, upload_url)
+            except VKAPIError as e:
+                rejection = e.message
+            else:
+                # Проверяем, что все необходимые параметры присутствуют и значение photo не пустое
+                if photo_data.get('photo') and 'server' in photo_data and 'hash' in photo_data:
+                    return {'photo': photo_data['photo'], 'server': photo_data['server'], 'hash': photo_data['hash']}
+                rejection = f"missing required fields in photo upload response: {photo_data}"
+            # Адрес могли уже обновить по отказу для другого фото - тогда новый не сбрасываем
+            upload_server_cache.invalidate(group_id, only_if=lambda server: server['upload_url'] == upload_url)
+            logger.warning(f"VK upload server rejected photo (attempt {attempt + 1}): {rejection}")
     except Exception as e:
         logger.error(f"Failed to upload photo to VK wall: {e}", exc_info=True)
-        return None
+    return None
+
+def _photo_attachment(saved: list[dict]) -> str:
+    """Идентификатор сохраненного фото в формате photo{owner_id}_{id}"""
+    photo = saved[0]
+    return f"photo{int(photo['owner_id'])}_{int(photo['id'])}"
+
+async def save_wall_photo(bot: Bot, file_info: File, group_id: int) -> tuple[str | None, bool]:
+    """Загружает фото на стену группы; возвращает (вложение или None, True - если фото загружено сейчас, а не взято из кэша)"""
+    # Это фото уже сохранено на стене группы - повторно не загружаем
+    cached = photo_cache.get(file_info.file_unique_id, group_id)
+    if cached:
+        return cached, False
+
+    photo_data = await _upload_photo_file(bot, file_info, group_id)
+    if not photo_data:
+        return None, False
 
-async def check_vk_user_token_permissions(access_token: str, group_id: str) -> bool:
-    """Проверка прав токена пользователя на публикацию от имени группы"""
+    # Сохраняем фото на стене группы
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=15.0)) as client:
-            # Проверяем права токена пользователя на публикацию от имени группы
-            response = await client.get(
-                "https://api.vk.com/method/groups.getById",
-                params={
-                    'group_id': abs(int(group_id)),
-                    'access_token': access_token,
-                    'v': '5.131',
-                    'fields': 'is_admin'
-                }
-            )
-            try:
-                result = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON response from VK API: {response.text}")
-                return False
-            
-            # Если есть ошибка, значит токен может быть неправильным
-            if 'error' in result:
-                error_code = result['error'].get('error_code', 0)
-                error_msg = result['error'].get('error_msg', 'Unknown error')
-                logger.error(f"VK API error checking user token permissions: {error_code} - {error_msg}")
-                return False
-            
-            # Если группа получена, токен может быть правильным
-            if 'response' in result and result['response']:
-                group_info = result['response'][0]
-                # Проверяем, является ли пользователь администратором группы
-                if group_info.get('is_admin', 0) == 1:
-                    return True
-                else:
-                    logger.warning(f"User is not admin of the group: {group_info}")
-                    return False
-            
-            return False
+        saved = await vk_client.call("photos.saveWallPhoto", group_id=group_id, **photo_data)
+    except VKAPIError as e:
+        log_vk_error("saving wall photo", e)
+        return None, False
+
+    if not saved:
+        logger.error(f"Empty response when saving wall photo: {saved}")
+        return None, False
+
+    attachment = _photo_attachment(saved)
+    photo_cache.put(file_info.file_unique_id, group_id, attachment)
+    return attachment, True
+
+async def delete_wall_photos(attachments: list[str]) -> int:
+    """Удаляет из VK фото, загруженные для поста, который так и не опубликовали; возвращает число удаленных"""
+    calls = []
+    for attachment in attachments:
+        owner_id, photo_id = attachment.removeprefix("photo").split("_", 1)
+        calls.append(("photos.delete", {'owner_id': int(owner_id), 'photo_id': int(photo_id)}))
+    if not calls:
+        return 0
+    try:
+        results = await vk_client.execute_calls(calls)
     except Exception as e:
-        logger.error(f"Failed to check VK user token permissions: {e}")
-        return False
+        logger.error(f"Failed to delete unused photos from VK: {e}")
+        return 0
+    deleted = 0
+    for item in results:
+        if isinstance(item, VKAPIError):
+            log_vk_error("deleting unused photo", item)
+        else:
+            deleted += 1
+    return deleted
+
+def _permissions_key(access_token: str, group_id: int | str) -> tuple:
+    return ("permissions", access_token, abs(int(group_id)))
+
+def _is_group_admin(groups: list[dict] | None) -> bool:
+    """Разбирает ответ groups.getById с полем is_admin"""
+    # Если группа получена, токен может быть правильным
+    if groups:
+        group_info = groups[0]
+        # Проверяем, является ли пользователь администратором группы
+        if group_info.get('is_admin', 0) == 1:
+            return True
+        logger.warning(f"User is not admin of the group: {group_info}")
+    return False
 
 async def get_group_id_by_screen_name(screen_name: str, access_token: str) -> int | None:
-    """Получение ID группы по screen_name"""
+    """Получение ID группы по screen_name (с кэшированием)"""
+    return await vk_lookup_cache.get_or_load(
+        ("group_id", access_token, screen_name),
+        lambda: _get_group_id_by_screen_name(screen_name, access_token),
+    )
+
+async def _get_group_id_by_screen_name(screen_name: str, access_token: str) -> int | None:
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=15.0)) as client:
-            response = await client.get(
-                "https://api.vk.com/method/utils.resolveScreenName",
-                params={
-                    'screen_name': screen_name,
-                    'access_token': access_token,
-                    'v': '5.131'
-                },
-                timeout=httpx.Timeout(timeout=15.0),
-                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            )
-            try:
-                result = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON response from VK API: {response.text}")
-                return None
-            
-            if 'error' in result:
-                error_code = result['error'].get('error_code', 0)
-                error_msg = result['error'].get('error_msg', 'Unknown error')
-                logger.error(f"VK API error resolving screen name: {error_code} - {error_msg}")
-                return None
-            
-            if 'response' in result and result['response']:
-                response_obj = result['response']
-                if response_obj.get('type') == 'group':
-                    return int(response_obj.get('object_id'))
-            
-            return None
+        response_obj = await vk_client.call("utils.resolveScreenName", screen_name=screen_name, access_token=access_token)
+    except VKAPIError as e:
+        logger.error(f"VK API error resolving screen name: {e.code} - {e.message}")
+        return None
     except Exception as e:
         logger.error(f"Failed to resolve screen name to group ID: {e}")
         return None
 
-async def publish_vk_post(bot: Bot, text: str, photo_ids: list[str] | None = None):
-    """Публикация поста на стене группы ВКонтакте (текст + фото одним постом)"""
-    if not config.VK_USER_TOKEN:
-        logger.warning("VK user token is not configured. Skipping VK publication.")
-        return False
+    if response_obj and response_obj.get('type') == 'group':
+        return int(response_obj.get('object_id'))
+    return None
 
+async def resolve_group_id() -> int | None:
+    """ID группы VK из VK_GROUP_ID или по VK_GROUP_SCREEN_NAME"""
     # Если VK_GROUP_ID не задан числом, пробуем получить его по screen_name
     group_id = config.VK_GROUP_ID
     if not group_id or group_id == 0:
@@ -222,93 +239,185 @@ async def publish_vk_post(bot: Bot, text: str, photo_ids: list[str] | None = Non
             group_id = await get_group_id_by_screen_name(vk_group_screen_name, config.VK_USER_TOKEN)
             if not group_id:
                 logger.error("Could not resolve group ID by screen name. Skipping VK publication.")
-                return False
+                return None
         else:
             logger.error("Neither VK_GROUP_ID nor VK_GROUP_SCREEN_NAME is configured. Skipping VK publication.")
-            return False
+            return None
+    return group_id
+
+async def publish_vk_post(
+    bot: Bot,
+    text: str,
+    photo_ids: list[str] | None = None,
+    *,
+    preuploaded: dict[str, str] | None = None,
+    guid: str | None = None,
+    reuse_cached_photos: bool = True,
+) -> int | None:
+    """Публикация поста на стене группы ВКонтакте (текст + фото одним постом); возвращает id поста или None при ошибке
 
-    # Проверяем права токена пользователя перед публикацией
-    if not await check_vk_user_token_permissions(config.VK_USER_TOKEN, str(group_id)):
-        logger.error("VK user token does not have permission to post as the group. "
-                   "This may indicate that the user token doesn't have admin rights for the group. "
-                   "Consider using a user token with admin rights for the group. "
-                   "Error details: User token permissions check failed")
-        return False
+    preuploaded - вложения для фото, заранее загруженных в VK (file_id -> photo{owner_id}_{id}).
+    guid - ключ идемпотентности: повторный wall.post с тем же guid не создает второй пост.
+    reuse_cached_photos=False - не брать фото из кэша загруженных (повтор после того, как VK отверг кэшированные).
+    """
+    if not config.VK_USER_TOKEN:
+        logger.warning("VK user token is not configured. Skipping VK publication.")
+        return None
+
+    group_id = await resolve_group_id()
+    if not group_id:
+        return None
 
     if photo_ids is None:
         photo_ids = []
-    
-    # Загружаем фото на стену группы
-    attachments = []
-    if photo_ids:
-        for file_id in photo_ids:
-            vk_photo_id = await upload_photo_to_vk_wall(bot, file_id)
-            if vk_photo_id:
-                attachments.append(vk_photo_id)
-                logger.info(f"Uploaded photo to VK wall: {vk_photo_id}")
-            # Небольшая задержка между загрузками
-            await asyncio.sleep(0.5)
-    
-    # Формируем строку вложений для публикации
-    attachments_str = ",".join(attachments) if attachments else ""
-    
-    # Публикуем пост на стене группы
-    post_params = {
-        'owner_id': -int(group_id),  # Отрицательный ID для группы
-        'from_group': 1,  # Публикуем от имени группы
-        'message': text[:4096],  # Ограничение длины текста для VK API
-        'attachments': attachments_str,  # Фото в формате "photo{owner_id}_{id}"
-        'access_token': config.VK_USER_TOKEN,
-        'v': '5.131'
-    }
-    
+    vk_group_id = abs(int(group_id))
+
+    # Фото, уже сохраненные на стене группы, берем из кэша по file_unique_id - без повторной загрузки
+    photos: list[str | File | None] = []  # Готовое вложение, файл для загрузки или None при ошибке
+    cached_photos: dict[str, str] = {}
+    # Заранее загруженные фото уже на стене группы - для них не нужен даже get_file
+    preuploaded = preuploaded or {}
+    to_resolve = [file_id for file_id in photo_ids if file_id not in preuploaded]
+    resolved = dict(zip(to_resolve, await asyncio.gather(*(bot.get_file(file_id) for file_id in to_resolve), return_exceptions=True)))
+    for file_id in photo_ids:
+        if file_id in preuploaded:
+            photos.append(preuploaded[file_id])
+            continue
+        file_info = resolved[file_id]
+        if isinstance(file_info, Exception):
+            logger.error(f"Failed to get Telegram file {file_id}: {file_info}")
+            photos.append(None)
+            continue
+        cached = photo_cache.get(file_info.file_unique_id, vk_group_id) if reuse_cached_photos else None
+        if cached:
+            cached_photos[file_info.file_unique_id] = cached
+        photos.append(cached or file_info)
+    to_upload = [photo for photo in photos if isinstance(photo, File)]
+
+    # Проверку прав и адрес для загрузки фото (если их нет в кэше) получаем одним запросом execute
+    permissions_key = _permissions_key(config.VK_USER_TOKEN, group_id)
+    calls = []
+    check_permissions = not vk_lookup_cache.get(permissions_key)
+    if check_permissions:
+        calls.append(("groups.getById", {'group_id': vk_group_id, 'fields': 'is_admin'}))
+    fetch_upload_server = bool(to_upload) and not upload_server_cache.get(vk_group_id)
+    if fetch_upload_server:
+        calls.append(("photos.getWallUploadServer", {'group_id': vk_group_id}))
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=15.0)) as client:
-            response = await client.post(
-                "https://api.vk.com/method/wall.post",
-                data=post_params,
-                timeout=httpx.Timeout(timeout=15.0),
-                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            )
-            try:
-                result = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON response from VK API: {response.text}")
-                return False
-            
-            # Проверяем на ошибки
-            if 'error' in result:
-                error = result['error']
-                error_code = error.get('error_code', 'Unknown')
-                error_msg = error.get('error_msg', 'Unknown error')
-                
-                # Специальная обработка ошибки 214 (Access to adding post denied)
-                if error_code == 214:
-                    logger.error(f"VK API error 214 posting to wall: Access to adding post denied. "
-                               f"Это означает, что у токена нет прав на публикацию от имени группы или на стене запрещены публикации для данного пользователя. "
-                               f"Причины ошибки и способы устранения:\n"
-                               f"1. ❌ Неправильный токен: Убедитесь, что используете токен пользователя-администратора группы, а не токен самой группы\n"
-                               f"2. ⚙️ Настройки группы: Перейдите в настройки группы → 'Управление сообществом' и убедитесь, что разрешена публикация от имени сообщества\n"
-                               f"3. 👤 Права токена: Токен должен быть получен от пользователя с правами администратора группы\n"
-                               f"4. 🌐 Параметры API: Убедитесь, что передаете правильные параметры, включая owner_id группы с префиксом '-' (например, -ID группы)\n"
-                               f"5. ⏳ Лимиты публикаций: Если ошибка связана с лимитом публикаций, подождите некоторое время перед повторной попыткой\n\n"
-                               f"✅ Решение: Используйте токен ПОЛЬЗОВАТЕЛЯ с правами администратора группы, а не токен самой группы. "
-                               f"Только токен пользователя с правами администратора группы может публиковать посты от имени группы. "
-                               f"Error details: {error_msg}")
-                elif error_code == 27:  # Group authorization failed
-                    logger.error(f"VK API error 27: Group authorization failed. "
-                               f"Это означает, что используется токен группы вместо токена пользователя-администратора. "
-                               f"Error details: {error_msg}")
-                else:
-                    logger.error(f"VK API error posting to wall: {error_code} - {error_msg}")
-                
-                return False
-            
-            logger.info("Successfully posted to VK wall.")
-            return True
-            
+        results = await vk_client.execute_calls(calls) if calls else []
+    except VKAPIError as e:
+        log_vk_error("preparing publication", e)
+        return None
+    except Exception as e:
+        logger.error(f"Failed to prepare VK publication: {e}", exc_info=False)
+        return None
+
+    if check_permissions:
+        groups = results.pop(0)
+        if isinstance(groups, VKAPIError):
+            logger.error(f"VK API error checking user token permissions: {groups.code} - {groups.message}")
+            groups = None
+        # Проверяем права токена пользователя перед публикацией
+        if not _is_group_admin(groups):
+            logger.error("VK user token does not have permission to post as the group. "
+                       "This may indicate that the user token doesn't have admin rights for the group. "
+                       "Consider using a user token with admin rights for the group. "
+                       "Error details: User token permissions check failed")
+            return None
+        vk_lookup_cache.put(permissions_key, True)
+
+    if fetch_upload_server:
+        upload_server = results.pop(0)
+        if isinstance(upload_server, VKAPIError):
+            log_vk_error("getting wall upload server", upload_server)
+        elif _has_upload_url(upload_server):
+            upload_server_cache.put(vk_group_id, upload_server)
+
+    # Загружаем новые фото на сервер VK параллельно по общему адресу; gather возвращает результаты в исходном порядке фото
+    uploaded = await asyncio.gather(*(_upload_photo_file(bot, file_info, vk_group_id) for file_info in to_upload))
+    uploaded_by_file = dict(zip((file_info.file_id for file_info in to_upload), uploaded))
+    prepared = [uploaded_by_file[photo.file_id] if isinstance(photo, File) else photo for photo in photos]
+    reused = len(cached_photos) + sum(1 for file_id in photo_ids if file_id in preuploaded)
+    if reused:
+        logger.info(f"Reusing {reused} photos already saved to VK wall")
+
+    # Сохраняем фото и публикуем пост одним запросом execute
+    try:
+        saved, post = await _save_photos_and_post(vk_group_id, text, prepared, guid)
+    except VKAPIError as e:
+        log_vk_error("posting to wall", e)
+        return None
     except Exception as e:
         logger.error(f"Failed to post to VK wall: {e}", exc_info=False)
-        return False
-    
-# Удаляем дублирующийся код после функции publish_vk_post
\ No newline at end of file
+        return None
+
+    # saved содержит результаты saveWallPhoto по порядку успешно загруженных фото
+    fresh: dict[str, str] = {}  # file_id -> вложение для фото, сохраненных на стене этим вызовом
+    for file_info, item in zip((f for f, photo_data in zip(to_upload, uploaded) if photo_data), saved):
+        if isinstance(item, VKAPIError):
+            log_vk_error("saving wall photo", item)
+        elif item:
+            fresh[file_info.file_id] = _photo_attachment(item)
+            photo_cache.put(file_info.file_unique_id, vk_group_id, fresh[file_info.file_id])
+    uploaded_count = len(fresh)
+    if photo_ids:
+        logger.info(f"Photos for VK post: {uploaded_count} uploaded, {reused} reused, {len(photo_ids)} total")
+
+    if isinstance(post, VKAPIError):
+        # Фото из кэша могли удалить из VK - забываем их и публикуем заново, загрузив повторно только их.
+        # Заранее загруженные и только что сохраненные фото берем как есть, чтобы не плодить копии на стене
+        if post.code == INVALID_PARAMETER and cached_photos and reuse_cached_photos:
+            logger.warning(f"VK rejected the post with cached photos ({post.message}), re-uploading {len(cached_photos)} of them")
+            for file_unique_id in cached_photos:
+                photo_cache.remove(file_unique_id, vk_group_id)
+            return await publish_vk_post(
+                bot, text, photo_ids, preuploaded={**preuploaded, **fresh}, guid=guid, reuse_cached_photos=False,
+            )
+        log_vk_error("posting to wall", post)
+        return None
+
+    logger.info(f"Successfully posted to VK wall (post {post['post_id']}).")
+    return int(post['post_id'])
+
+async def find_wall_post(text: str, since: float) -> int | None:
+    """Ищет на стене группы пост с этим текстом, опубликованный не раньше since; возвращает его id или None.
+
+    Ошибку VK не глушит: если проверить не удалось, публиковать повторно нельзя.
+    """
+    group_id = await resolve_group_id()
+    if not group_id:
+        return None
+    response = await vk_client.call("wall.get", owner_id=-abs(int(group_id)), count=WALL_CHECK_POSTS, filter="owner")
+    message = text[:4096].strip()
+    for item in (response or {}).get('items', []):
+        if item.get('date', 0) >= since and (item.get('text') or '').strip() == message:
+            return int(item['id'])
+    return None
+
+async def _save_photos_and_post(group_id: int, text: str, photos: list[str | dict | None], guid: str | None = None) -> tuple[list, object]:
+    """Сохраняет загруженные фото и публикует пост одним VKScript; возвращает (результаты saveWallPhoto, результат wall.post)
+
+    photos - по порядку поста: готовое вложение из кэша, параметры для photos.saveWallPhoto или None (фото пропускается).
+    """
+    # Вложения собираются внутри скрипта из кэшированных и успешно сохраненных фото, в исходном порядке
+    lines = ['var a = ""; var s = "";']
+    saves = 0
+    for photo in photos:
+        if isinstance(photo, str):
+            lines.append(f"a = a + s + {json.dumps(photo)}; s = \",\";")
+        elif photo:
+            params = json.dumps({'group_id': group_id, **photo}, ensure_ascii=False)
+            lines.append(f"var r{saves} = API.photos.saveWallPhoto({params});")
+            lines.append(f'if (r{saves}) {{ a = a + s + "photo" + r{saves}[0].owner_id + "_" + r{saves}[0].id; s = ","; }}')
+            saves += 1
+    # Текст передается аргументом execute, чтобы не экранировать его внутри кода
+    # Отрицательный owner_id - стена группы, from_group - публикуем от имени группы
+    args = {'message': text[:4096]}  # Ограничение длины текста для VK API
+    post_params = f'"owner_id": {-group_id}, "from_group": 1, "message": Args.message, "attachments": a'
+    if guid:
+        args['guid'] = guid
+        post_params += ', "guid": Args.guid'
+    lines.append(f'var post = API.wall.post({{{post_params}}});')
+    lines.append("return [" + "".join(f"r{i}, " for i in range(saves)) + "post];")
+    results = await vk_client.execute("\n".join(lines), saves + 1, **args)
+    return results[:-1], results[-1]